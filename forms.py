@@ -265,6 +265,7 @@ class SystemNoteForm(ModelFormManager):
 			ntype = get_object_or_404(NoteType, type__iexact='note')
 			note = Note(category=self._note_category, type=ntype,
 					created_by=user, note=note_body)
+			note.is_system_change = True
 		return note
 
 
@@ -807,6 +808,7 @@ class ProjectTaskNoteForm(NoteForm):
 		update_message = update_message.strip()
 		if update_message:
 			update_message = '<span style="color:#888; font-style:italic;">%s</span>\n\n' % update_message
+			m.is_system_change = True
 		m.note = '%s%s' % (update_message, m.note)
 		m.save()
 		return m
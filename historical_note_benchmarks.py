@@ -0,0 +1,564 @@
+'''
+Benchmarks for the Issue Changelog queries. These are run by hand from
+"manage.py shell" against a copy of the database, for example:
+
+	>>> from app import historical_note_benchmarks as b
+	>>> b.benchmark_issue_id_binding()
+	>>> b.benchmark_concurrent_halves()
+	>>> b.benchmark_changelog(sizes=(10000, 100000))
+	>>> b.benchmark_row_assembly()
+
+compare_changelog_filters() is run the same way to check the changelog's
+filters against the old search of the notes' text.
+'''
+import time
+from django.db import connection, transaction
+from app.historical_note_models import backfill_issue_change_events, \
+		SYSTEM_NOTE_WHERE
+
+# ==============================================================================
+def _explain_times(sql, params):
+	'''
+	Runs the query under EXPLAIN ANALYZE and returns the planning time and the
+	execution time reported by Postgres along with the wall time in milliseconds.
+	The wall time includes sending and parsing the query text.
+	'''
+	cursor = connection.cursor()
+	start = time.time()
+	cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params)
+	plan = cursor.fetchone()[0]
+	wall_time = (time.time() - start) * 1000
+
+	# Older versions of psycopg2 don't decode json columns
+	if isinstance(plan, basestring):
+		import json
+		plan = json.loads(plan)
+	plan = plan[0]
+	return plan.get('Planning Time', 0), plan.get('Execution Time', 0), wall_time
+
+def _get_benchmark_issue_ids(total):
+	# Uses the real Issue IDs and pads them out with made up ones when there
+	# aren't enough Issues in the database
+	cursor = connection.cursor()
+	cursor.execute('SELECT issuesid FROM issues ORDER BY issuesid DESC LIMIT %s',
+			[total])
+	issueids = [_[0] for _ in cursor.fetchall()]
+	next_id = (issueids and max(issueids) or 0) + 1
+	while len(issueids) < total:
+		issueids.append(next_id)
+		next_id += 1
+	return issueids
+
+# ==============================================================================
+def _load_temp_issue_ids(issueids):
+	'''
+	Loads the Issue IDs into the bench_issue_ids temporary table with COPY, so
+	they are sent as data instead of as query text. Returns the time it took in
+	milliseconds.
+	'''
+	from cStringIO import StringIO
+
+	cursor = connection.cursor()
+	start = time.time()
+	cursor.execute('''
+	CREATE TEMPORARY TABLE IF NOT EXISTS bench_issue_ids (issue integer PRIMARY KEY)
+	''')
+	cursor.execute('TRUNCATE bench_issue_ids')
+	cursor.copy_from(StringIO('\n'.join([str(_) for _ in issueids])),
+			'bench_issue_ids')
+	cursor.execute('ANALYZE bench_issue_ids')
+	return (time.time() - start) * 1000
+
+def benchmark_issue_id_binding(sizes=(50, 5000, 50000), runs=3):
+	'''
+	Compares three ways of passing the Issue IDs to the notes half of the
+	changelog query: an interpolated "IN (1,2,3...)" list, an array parameter
+	("= ANY(%s)") and a temporary table loaded with COPY. Prints the size of
+	the statement that is sent to Postgres, with the parameters filled in, and
+	the best planning, execution and wall time of each in milliseconds. The
+	temporary table's wall time includes loading it.
+	'''
+	# The binding is filled in with % below, so SYSTEM_NOTE_WHERE's %% are
+	# doubled to come out as the %% that the query's parameters need
+	sql = '''
+	SELECT n.notesid, n.entry_date, n.issue FROM notes n
+	JOIN issues i ON (n.issue=i.issuesid)
+	WHERE n.is_active AND n.issue %s AND
+	''' + SYSTEM_NOTE_WHERE.replace('%', '%%') + '''
+	ORDER BY n.issue, n.entry_date, n.notesid
+	'''
+
+	print '%8s  %-10s %10s %10s %10s %10s' % ('ids', 'binding', 'sql bytes',
+			'plan ms', 'exec ms', 'wall ms')
+	for size in sizes:
+		issueids = _get_benchmark_issue_ids(size)
+		tests = [
+			('IN list', sql % ('IN (%s)' % ','.join([str(_) for _ in issueids])), []),
+			('ANY array', sql % '= ANY(%s)', [issueids]),
+			('temp table', sql % 'IN (SELECT issue FROM bench_issue_ids)', []),
+		]
+		for label, test_sql, params in tests:
+			load_time = 0
+			if label == 'temp table':
+				load_time = _load_temp_issue_ids(issueids)
+			# psycopg2 fills the parameters in on the client, so this is the
+			# text that Postgres gets
+			sql_bytes = len(connection.cursor().mogrify(test_sql, params))
+
+			results = [_explain_times(test_sql, params) for _ in range(runs)]
+			plan_time = min([_[0] for _ in results])
+			exec_time = min([_[1] for _ in results])
+			wall_time = min([_[2] for _ in results]) + load_time
+			print '%8s  %-10s %10s %10.1f %10.1f %10.1f' % (size, label,
+					sql_bytes, plan_time, exec_time, wall_time)
+
+# ==============================================================================
+def benchmark_concurrent_halves(sizes=(50, 500, 5000), runs=3):
+	'''
+	Compares the single UNION ALL source query with running its notes and
+	emails halves at the same time on two connections and merging them in
+	Python. Prints the best wall time of each in milliseconds and checks that
+	both return the same rows.
+	'''
+	from app.historical_note_models import get_source_change_rows
+
+	print '%8s %12s %12s %8s  %s' % ('ids', 'serial ms', 'concurrent ms',
+			'speedup', 'rows')
+	for size in sizes:
+		issueids = _get_benchmark_issue_ids(size)
+		times = {}
+		rows = {}
+		for concurrent in (False, True):
+			best = None
+			for dummy in range(runs):
+				start = time.time()
+				cols, rows[concurrent] = get_source_change_rows(issueids,
+						concurrent)
+				wall_time = (time.time() - start) * 1000
+				if best is None or wall_time < best:
+					best = wall_time
+			times[concurrent] = best
+
+		if rows[False] != rows[True]:
+			print '%8s  the concurrent rows don\'t match the serial rows' % size
+		print '%8s %12.1f %12.1f %7.2fx  %s' % (size, times[False], times[True],
+				times[False] / max(times[True], 0.001), len(rows[False]))
+
+# ==============================================================================
+# ========================== SYNTHETIC CHANGELOG DATA ==========================
+# ==============================================================================
+# Every generated Issue's title starts with this so the data can be removed
+BENCH_TITLE_PREFIX = 'BENCH '
+
+# The fields written into the generated system notes, in the wording that the
+# changelog's note parsing looks for
+BENCH_NOTE_FIELDS = ['Title', 'Issue Project', 'Issue Type', 'Issue Disposition',
+		'Reported By', 'Tickets']
+
+def _get_lookup_values(sql):
+	# Returns the IDs and names of a lookup table as two lists
+	cursor = connection.cursor()
+	cursor.execute(sql, [])
+	rows = cursor.fetchall()
+	return [_[0] for _ in rows], [_[1] for _ in rows]
+
+def generate_changelog_data(total_notes=10000, notes_per_issue=10,
+		emails_per_issue=2):
+	'''
+	Fills the issues, notes, emails, replies and email_addresses tables with
+	made up Issues that have total_notes notes between them. Three of every
+	four notes are system notes with a "Changed X from ... to ..." <span> like
+	the ones the forms write. The emails are sent before the Issue's first note
+	so they show up in the changelog. Run this against a scratch copy of the
+	database; delete_changelog_data() removes the rows again.
+	'''
+	from app.historical_note_models import update_issue_first_notes, \
+			add_system_change_flag
+
+	# The generated notes are flagged as system notes
+	add_system_change_flag()
+
+	type_ids, type_names = _get_lookup_values(
+			'SELECT issue_typesid, type FROM issue_types ORDER BY 1')
+	disp_ids, disp_names = _get_lookup_values(
+			'SELECT issue_dispositionsid, disposition FROM issue_dispositions ORDER BY 1')
+	project_ids, project_names = _get_lookup_values(
+			'SELECT issue_projectsid, name FROM issue_projects ORDER BY 1')
+	person_ids, person_names = _get_lookup_values('''
+			SELECT peopleid, first_name || ' ' || last_name FROM people
+			ORDER BY 1 LIMIT 500''')
+	note_type_ids, dummy = _get_lookup_values(
+			"SELECT note_typesid, type FROM note_types WHERE type ILIKE 'note'")
+	category_ids, dummy = _get_lookup_values(
+			"SELECT note_categoriesid, category FROM note_categories WHERE category ILIKE 'issue'")
+	user_ids, dummy = _get_lookup_values(
+			'SELECT id, username FROM auth_user WHERE is_superuser ORDER BY 1 LIMIT 20')
+
+	total_issues = max(total_notes / notes_per_issue, 1)
+	cursor = connection.cursor()
+
+	# ----------------------------------------------------------------------
+	cursor.execute('''
+	INSERT INTO issues (title, tickets, person, issue_type, issue_disposition,
+		issue_projectsid)
+	SELECT %s || 'Issue ' || g,
+		CASE WHEN g %% 4 = 0 THEN 'FB' || g ELSE '' END,
+		(%s::int[])[1 + g %% array_length(%s::int[], 1)],
+		(%s::int[])[1 + g %% array_length(%s::int[], 1)],
+		(%s::int[])[1 + g %% array_length(%s::int[], 1)],
+		(%s::int[])[1 + g %% array_length(%s::int[], 1)]
+	FROM generate_series(1, %s) g
+	''', [BENCH_TITLE_PREFIX, person_ids, person_ids, type_ids, type_ids,
+			disp_ids, disp_ids, project_ids, project_ids, total_issues])
+
+	# ----------------------------------------------------------------------
+	# Each system note changes one field. The new value is picked from the real
+	# lookup values so the change events can be tied to their IDs.
+	new_values = '''CASE g %% 6
+		WHEN 0 THEN %s || 'Issue ' || i.issuesid || ' rev ' || g
+		WHEN 1 THEN (%s::text[])[1 + g %% array_length(%s::text[], 1)]
+		WHEN 2 THEN (%s::text[])[1 + g %% array_length(%s::text[], 1)]
+		WHEN 3 THEN (%s::text[])[1 + g %% array_length(%s::text[], 1)]
+		WHEN 4 THEN (%s::text[])[1 + g %% array_length(%s::text[], 1)]
+		ELSE 'FB' || (i.issuesid * 10 + g) END'''
+	cursor.execute('''
+	INSERT INTO notes (issue, note, entry_date, category, type, issue_person,
+		created_by, is_active, is_system_change)
+	SELECT i.issuesid,
+		CASE WHEN g %% 4 = 3 THEN 'Called the agency back about the issue.'
+		ELSE '<span style="color:#888; font-style:italic;">Changed ' ||
+			(%s::text[])[1 + g %% 6] || ' to "' || ''' + new_values + ''' ||
+			'"</span>' END,
+		timestamp '2010-01-01' + (i.issuesid %% 1500) * interval '1 day' +
+			g * interval '37 minutes',
+		%s, %s, i.person,
+		(%s::int[])[1 + g %% array_length(%s::int[], 1)],
+		true, g %% 4 != 3
+	FROM issues i CROSS JOIN generate_series(1, %s) g
+	WHERE i.title LIKE %s
+	''', [BENCH_NOTE_FIELDS, BENCH_TITLE_PREFIX, project_names, project_names,
+			type_names, type_names, disp_names, disp_names, person_names,
+			person_names, category_ids[0], note_type_ids[0], user_ids, user_ids,
+			notes_per_issue, BENCH_TITLE_PREFIX + '%'])
+
+	# ----------------------------------------------------------------------
+	cursor.execute('''
+	INSERT INTO email_addresses (person, email)
+	SELECT p, 'bench' || p || '@example.com' FROM unnest(%s::int[]) p
+	WHERE NOT EXISTS (SELECT 1 FROM email_addresses ea WHERE ea.person=p)
+	''', [person_ids])
+
+	cursor.execute('''
+	INSERT INTO emails (issue, subject, body, add_date, is_active, was_received)
+	SELECT i.issuesid, '[zt ' || i.issuesid || '] ' || i.title,
+		repeat('The report will not print for this user. ', 50),
+		timestamp '2010-01-01' + (i.issuesid %% 1500) * interval '1 day' -
+			g * interval '1 day',
+		true, true
+	FROM issues i CROSS JOIN generate_series(1, %s) g
+	WHERE i.title LIKE %s
+	''', [emails_per_issue, BENCH_TITLE_PREFIX + '%'])
+
+	cursor.execute('''
+	INSERT INTO replies (email, reply_type, email_address)
+	SELECT e.emailsid, 1, (SELECT MIN(ea.email_addressesid) FROM email_addresses ea
+		WHERE ea.person=i.person)
+	FROM emails e JOIN issues i ON (i.issuesid=e.issue)
+	WHERE i.title LIKE %s
+	''', [BENCH_TITLE_PREFIX + '%'])
+
+	# Fill the side tables that the changelog reads from
+	update_issue_first_notes()
+	transaction.commit_unless_managed()
+	for dummy in backfill_issue_change_events():
+		pass
+	return total_issues
+
+def delete_changelog_data():
+	# Removes everything that generate_changelog_data() added
+	cursor = connection.cursor()
+	params = [BENCH_TITLE_PREFIX + '%']
+	bench_issues = 'SELECT issuesid FROM issues WHERE title LIKE %s'
+	cursor.execute('DELETE FROM issue_state_snapshots WHERE issue IN (' + bench_issues + ')', params)
+	cursor.execute('DELETE FROM issue_change_events WHERE issue IN (' + bench_issues + ')', params)
+	cursor.execute('DELETE FROM issue_changelog_versions WHERE issue IN (' + bench_issues + ')', params)
+	cursor.execute('DELETE FROM issue_first_notes WHERE issue IN (' + bench_issues + ')', params)
+	cursor.execute('''DELETE FROM replies WHERE email IN (
+		SELECT emailsid FROM emails WHERE issue IN (''' + bench_issues + '))', params)
+	cursor.execute('DELETE FROM emails WHERE issue IN (' + bench_issues + ')', params)
+	cursor.execute('DELETE FROM notes WHERE issue IN (' + bench_issues + ')', params)
+	cursor.execute('DELETE FROM issues WHERE title LIKE %s', params)
+	cursor.execute("DELETE FROM email_addresses WHERE email LIKE 'bench%%@example.com'", [])
+	transaction.commit_unless_managed()
+
+# ==============================================================================
+# ============================ CHANGELOG BENCHMARKS ============================
+# ==============================================================================
+def _measure(func, *args, **kwargs):
+	'''
+	Calls func and returns its result with the time spent in SQL, the time
+	spent in Python and the growth of the process's peak memory in KB. The
+	peak memory only grows, so each measurement is run in a new process by
+	_run_measured().
+	'''
+	import resource
+	from django.conf import settings
+	from django.core.cache import cache
+
+	# The per-issue changelog and search result caches would hide the work
+	# being measured
+	from app.historical_note_views import _get_result_cache
+	cache.clear()
+	_get_result_cache().clear()
+
+	# connection.queries is only kept while DEBUG is on
+	old_debug = settings.DEBUG
+	settings.DEBUG = True
+	connection.queries = []
+	start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start = time.time()
+	try:
+		result = func(*args, **kwargs)
+
+		# Streamed responses and the streamed "all" changelog don't do their
+		# work until they're read. iter_changelog_query() adds the server-side
+		# cursor's fetches to connection.queries, so they count as SQL time.
+		if hasattr(result, '_container'):
+			for dummy in result:
+				pass
+		elif isinstance(result, tuple) and hasattr(result[0], 'next'):
+			result = (list(result[0]),) + result[1:]
+	finally:
+		settings.DEBUG = old_debug
+
+	total_time = time.time() - start
+	sql_time = sum([float(_['time']) for _ in connection.queries])
+	peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+	connection.queries = []
+	return result, sql_time, total_time - sql_time, peak_kb
+
+def _run_measured(func, args, queue):
+	# Runs in its own process so that the peak memory belongs to one run
+	try:
+		queue.put(_measure(func, *args)[1:])
+	except Exception, e:
+		queue.put('failed: %s' % e)
+	connection.close()
+
+def benchmark_changelog(sizes=(10000, 100000, 1000000), notes_per_issue=10,
+		keep_data=False):
+	'''
+	Generates each size of synthetic changelog data in turn and times
+	process_request, get_historicalized_notes_and_emails and
+	export_issue_history_to_excel on it, for the first page and for the "all"
+	page. Each run is in a separate process. Prints the SQL time and Python
+	time in seconds and the peak memory growth in KB of every run.
+	'''
+	from multiprocessing import Process, Queue
+	from django.test.client import RequestFactory
+	from app import historical_note_views as views
+
+	rf = RequestFactory()
+	print '%9s  %-40s %9s %9s %10s' % ('notes', 'benchmark', 'sql s',
+			'python s', 'peak KB')
+	for size in sizes:
+		generate_changelog_data(size, notes_per_issue)
+		try:
+			first_page = rf.get('/', {'page': '1'})
+			all_pages = rf.get('/', {'page': 'all'})
+			tests = [
+				('process_request page 1', views.process_request,
+					[first_page, 1, 50]),
+				('process_request all', views.process_request,
+					[all_pages, 1, -1]),
+				('get_historicalized_notes_and_emails 1',
+					views.get_historicalized_notes_and_emails, [[], [], [], [], 1, 50]),
+				('get_historicalized_notes_and_emails all',
+					views.get_historicalized_notes_and_emails, [[], [], [], [], 1, -1]),
+				('export_issue_history_to_excel', views.export_issue_history_to_excel,
+					[all_pages]),
+			]
+			for label, func, args in tests:
+				# The child process has to open its own connection rather than
+				# share this one's socket
+				connection.close()
+				queue = Queue()
+				p = Process(target=_run_measured, args=(func, args, queue))
+				p.start()
+				measured = queue.get()
+				p.join()
+				if isinstance(measured, basestring):
+					print '%9s  %-40s %s' % (size, label, measured)
+					continue
+				sql_time, python_time, peak_kb = measured
+				print '%9s  %-40s %9.2f %9.2f %10s' % (size, label, sql_time,
+						python_time, peak_kb)
+		finally:
+			if not keep_data:
+				delete_changelog_data()
+
+# ==============================================================================
+# ============================== ROW ASSEMBLY ==================================
+# ==============================================================================
+def _legacy_assemble_issue_changes(cols, rows):
+	# The dictionary-per-row assembly that _assemble_issue_changes() replaced,
+	# kept here to compare against
+	issues = {}
+
+	def _check_row(r):
+		fields = ['changed_project', 'changed_issue_type', 'changed_issue_disposition',
+				'changed_reported_by', 'changed_tickets', 'changed_title']
+		for f in fields:
+			if r[f] and r[f].strip():
+				return True
+		return False
+
+	def _fill_history_fields(row, prev_row):
+		fields = ['project', 'issue_type', 'issue_disposition',
+				'reported_by', 'tickets', 'title']
+		for f in fields:
+			ckey = 'changed_%s' % f
+			hkey = 'history_%s' % f
+			crow = row.get(ckey, '')
+			if crow is None or crow.lower() == 'none':
+				row[ckey] = ' '
+			if crow in [prev_row.get(ckey, ''), prev_row.get(hkey, '')]:
+				row[ckey] = ''
+			row[hkey] = crow or prev_row.get(ckey, None) or prev_row.get(hkey, ' ')
+			row[hkey] = row[hkey].strip()
+		return row
+
+	prev_row = {}
+	for row in rows:
+		row = dict(zip(cols, row))
+		if row['issue_id'] != prev_row.get('issue_id'):
+			prev_row = {}
+		row = _fill_history_fields(row, prev_row)
+		if _check_row(row):
+			issues.setdefault(row['issue_id'], {'label': '%s - %s' % (
+					row['issue_id'], row['current_title']),
+				'changes': []})
+			issues[row['issue_id']]['changes'].append(row)
+		prev_row = row
+	return issues
+
+def _make_changelog_rows(total_rows, rows_per_issue):
+	# Made up changelog rows in CHANGELOG_COLUMNS order. Every row changes one
+	# field and every fifth one repeats the previous value.
+	from datetime import datetime, timedelta
+	values = ['Bug', 'Incident', 'Feature', 'In Support', 'Resolved', 'ledsSuite']
+	start = datetime(2010, 1, 1)
+	rows = []
+	for i in xrange(total_rows):
+		issue_id = i / rows_per_issue
+		changed = ['', '', '', '', '', '']
+		changed[i % 6] = values[(i / 5) % len(values)]
+		d = start + timedelta(minutes=i)
+		rows.append(('note', i, d, 1, issue_id,
+				changed[0], 'Issue %s' % issue_id, changed[1], 'ledsSuite',
+				changed[2], 'Bug', changed[3], 'In Support',
+				changed[4], 'Smith, John', changed[5], '',
+				'Note', d, 'Changed something'))
+	return rows
+
+def _run_assembly(assemble_name, total_rows, rows_per_issue, queue):
+	# Runs in its own process so that the peak memory belongs to one variant
+	import resource
+	from app.historical_note_models import CHANGELOG_COLUMNS
+	from app import historical_note_views as views
+
+	rows = _make_changelog_rows(total_rows, rows_per_issue)
+	start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start = time.time()
+	if assemble_name == 'legacy':
+		issues = _legacy_assemble_issue_changes(CHANGELOG_COLUMNS, rows)
+	else:
+		issues = views._assemble_issue_changes(rows)
+	total_time = time.time() - start
+	peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+	queue.put((total_time, peak_kb, sum([len(_['changes']) for _ in issues.values()])))
+
+def benchmark_row_assembly(total_rows=1000000, rows_per_issue=10):
+	'''
+	Compares the dictionary-per-row changelog assembly with the compact
+	ChangelogRow assembly on made up rows, without touching the database.
+	Each one runs in a separate process. Prints the time in seconds and the
+	peak memory growth in KB.
+	'''
+	from multiprocessing import Process, Queue
+
+	print '%9s  %-8s %9s %10s %10s' % ('rows', 'assembly', 'seconds',
+			'peak KB', 'kept rows')
+	for name in ['legacy', 'compact']:
+		queue = Queue()
+		p = Process(target=_run_assembly, args=(name, total_rows,
+				rows_per_issue, queue))
+		p.start()
+		total_time, peak_kb, kept_rows = queue.get()
+		p.join()
+		print '%9s  %-8s %9.2f %10s %10s' % (total_rows, name, total_time,
+				peak_kb, kept_rows)
+
+# ==============================================================================
+# ============================ FILTER COMPARISON ===============================
+# ==============================================================================
+# The filters of the FilterIssueNoteHistory form that are matched against the
+# issue_change_events table, with the query for the values to try
+COMPARED_FILTERS = [
+	('issue_type', 'SELECT issue_typesid, type FROM issue_types ORDER BY 1'),
+	('issue_disposition',
+		'SELECT issue_dispositionsid, disposition FROM issue_dispositions ORDER BY 1'),
+	('project', 'SELECT issue_projectsid, name FROM issue_projects ORDER BY 1'),
+	('related_to_relation', '''SELECT DISTINCT p.peopleid,
+		p.first_name || ' ' || p.last_name FROM people p
+		JOIN issues i ON (i.person=p.peopleid) ORDER BY 1 LIMIT 50'''),
+]
+
+def _find_filter_matches(get, use_events):
+	# Returns the IDs of the Issues that the changelog's filters find
+	from app.historical_note_views import get_filter_wheres, _get_issue_ids_sql
+
+	wheres, ewheres, wheres_args, ewheres_args = get_filter_wheres(get,
+			use_events)
+	cursor = connection.cursor()
+	cursor.execute('SELECT DISTINCT issue FROM (' +
+			_get_issue_ids_sql(wheres, ewheres) + ') AS ids',
+			wheres_args + ewheres_args)
+	return set([_[0] for _ in cursor.fetchall()])
+
+def compare_changelog_filters(filters=COMPARED_FILTERS, verbose=True):
+	'''
+	Runs the type, disposition, project and related to filters for each of
+	their values both ways: against the issue_change_events table and with the
+	old "n.note ILIKE '%type%to %X%'" search. Prints the number of Issues each
+	finds and up to ten of the Issues that only one of them finds. Returns a
+	list of (filter, value, Issues only the events find, Issues only the text
+	search finds).
+
+	Some differences are expected. The events match the value's ID, so "Bug"
+	no longer finds the changes to "Bug Fix". The related to filter searches
+	the text both ways and should always match.
+	'''
+	results = []
+	if verbose:
+		print '%-20s %-30s %8s %8s %8s %8s' % ('filter', 'value', 'events',
+				'ilike', 'events+', 'ilike+')
+	for name, sql in filters:
+		value_ids, value_names = _get_lookup_values(sql)
+		for value_id, value_name in zip(value_ids, value_names):
+			get = {name: str(value_id)}
+			by_events = _find_filter_matches(get, True)
+			by_text = _find_filter_matches(get, False)
+			only_events = sorted(by_events - by_text)
+			only_text = sorted(by_text - by_events)
+			results.append((name, value_name, only_events, only_text))
+
+			if verbose:
+				print '%-20s %-30s %8s %8s %8s %8s' % (name,
+						(value_name or '')[:30], len(by_events), len(by_text),
+						len(only_events), len(only_text))
+				if only_events:
+					print '    only the events: %s' % only_events[:10]
+				if only_text:
+					print '    only the text search: %s' % only_text[:10]
+	return results
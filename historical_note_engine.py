@@ -0,0 +1,345 @@
+'''
+The change history engine behind the Issue Changelog and the Project and
+Project Task histories.
+
+Each kind of object is a ChangeHistoryEntity that knows how to find its
+objects and build their changes. The engine gives all of them the same keyset
+paging, counts, per-object caching and streamed CSV export. The Issue entity
+is registered by historical_note_views; the note based entities are here.
+'''
+import re
+from django.conf import settings
+from app.historical_note_models import execute_changelog_query, \
+		iter_changelog_query, is_query_profile_running, SYSTEM_NOTE_WHERE
+from app.note_change_parser import parse_change_lines, get_note_span_text
+
+ENTITIES = {}
+
+def register_entity(entity):
+	# Makes the entity available to get_entity() and the history views
+	ENTITIES[entity.name] = entity
+	return entity
+
+def get_entity(name):
+	return ENTITIES[name]
+
+# ==============================================================================
+class ChangeHistoryEntity(object):
+	'''
+	The base class of the entities. The subclasses fill in:
+	  * name, used in the URLs and the cache keys.
+	  * id_column, the column name of the IDs returned by get_ids_sql().
+	  * csv_header, the first row of the CSV export.
+	'''
+	name = None
+	id_column = 'id'
+	csv_header = []
+
+	def get_filter_wheres(self, get):
+		'''
+		Turns the GET data of a history page into whatever get_ids_sql() takes
+		and its parameters.
+		'''
+		raise NotImplementedError
+
+	def get_ids_sql(self, wheres):
+		'''
+		Returns the query for the IDs of the objects that have changes matching
+		the wheres. It is used as a subquery, with the IDs in id_column.
+		'''
+		raise NotImplementedError
+
+	def get_versions(self, ids):
+		# Returns a dictionary of a value for each object that changes when
+		# its history does
+		raise NotImplementedError
+
+	def build_changes(self, ids):
+		# Returns a dictionary of the history of each object that has any
+		raise NotImplementedError
+
+	def get_csv_rows(self, object_id, history):
+		# Returns the CSV rows for the history of one object
+		raise NotImplementedError
+
+# ==============================================================================
+def count_ids(ids_sql, params, strategy='exact', cap=200, column='id'):
+	'''
+	Counts the objects found by the ids_sql query in the database. The strategy
+	can be:
+	  * 'exact' for the real count.
+	  * 'capped' to stop counting after cap objects. The count is cap + 1 when
+	    there are more, which is enough to tell if the query is large.
+	  * 'estimate' for the query planner's guess, which doesn't run the query
+	    at all. It can be well off when the statistics are stale.
+	'''
+	if strategy == 'capped':
+		cursor = execute_changelog_query('capped %s count' % column,
+				'SELECT COUNT(*) FROM (SELECT ' + column + ' FROM (' + ids_sql +
+				') AS ids LIMIT %s) AS capped', list(params) + [cap + 1])
+		return cursor.fetchone()[0]
+
+	if strategy == 'estimate':
+		cursor = execute_changelog_query('estimated %s count' % column,
+				'EXPLAIN SELECT ' + column + ' FROM (' + ids_sql + ') AS ids', params)
+		m = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+		if m:
+			return int(m.group(1))
+
+	cursor = execute_changelog_query('%s count' % column,
+			'SELECT COUNT(DISTINCT ' + column + ') FROM (' + ids_sql + ') AS ids',
+			params)
+	return cursor.fetchone()[0]
+
+def get_paged_ids(ids_sql, params, page=1, total_per_page=50, after_id=None,
+		column='id'):
+	'''
+	Returns the IDs for the page. A negative total_per_page returns every ID.
+	When after_id is given it is used as the keyset for the page instead of
+	the page number's offset.
+	'''
+	sql = 'SELECT ' + column + ' FROM (' + ids_sql + ') AS ids'
+	params = list(params)
+
+	if after_id:
+		sql += ' WHERE ' + column + ' > %s'
+		params.append(int(after_id))
+
+	sql += ' ORDER BY ' + column
+
+	# A negative total_per_page means that every object is shown
+	if total_per_page >= 0:
+		sql += ' LIMIT %s'
+		params.append(total_per_page)
+
+		if not after_id:
+			if page < 1: page = 1
+			sql += ' OFFSET %s'
+			params.append((page-1)*total_per_page)
+
+	cursor = execute_changelog_query('paged %s ids' % column, sql, params)
+	return [_[0] for _ in cursor.fetchall()]
+
+# ==============================================================================
+def get_changes(entity, ids):
+	'''
+	Returns the sorted (ID, history) pairs of the given objects that have any
+	changes. Each object's history is cached under its version, so only the
+	objects that have changed since they were last viewed get rebuilt. While
+	a query profile is running every history is rebuilt, so that the profile
+	has all of its queries.
+	'''
+	from django.core.cache import cache
+
+	versions = entity.get_versions(ids)
+	keys = dict([(i, 'change_history_%s_%s_%s' % (entity.name, i,
+			versions.get(i, 0))) for i in ids])
+	if is_query_profile_running():
+		cached = {}
+	else:
+		cached = cache.get_many(keys.values())
+
+	histories = {}
+	missing = []
+	for i in ids:
+		if keys[i] not in cached:
+			missing.append(i)
+		elif cached[keys[i]]:
+			histories[i] = cached[keys[i]]
+
+	if missing:
+		built = entity.build_changes(missing)
+		timeout = getattr(settings, 'ISSUE_CHANGELOG_CACHE_TIMEOUT', 60*60*24)
+		for i in missing:
+			# Objects without any changes are cached as an empty dictionary so
+			# that they don't get rebuilt every time either
+			cache.set(keys[i], built.get(i, {}), timeout)
+		histories.update(built)
+
+	return sorted(histories.items())
+
+def get_history_page(entity, wheres, params, page=1, total_per_page=50,
+		after_id=None, count='exact'):
+	'''
+	Returns the (ID, history) pairs of the page, the total number of objects
+	and the last ID on the page, to pass back in as after_id for the next page.
+	'''
+	ids_sql = entity.get_ids_sql(wheres)
+	total = count_ids(ids_sql, params, count, column=entity.id_column)
+	ids = get_paged_ids(ids_sql, params, page, total_per_page, after_id,
+			entity.id_column)
+	return get_changes(entity, ids), total, ids and ids[-1] or None
+
+# ==============================================================================
+class _CSVLineBuffer(object):
+	# File-like object for csv.writer that holds the lines until they're popped
+	def __init__(self):
+		self.lines = []
+
+	def write(self, line):
+		self.lines.append(line)
+
+	def pop(self):
+		lines = ''.join(self.lines)
+		self.lines = []
+		return lines
+
+def _encode_csv_value(value):
+	if value is None:
+		return ''
+	if hasattr(value, 'strftime'):
+		return value.strftime('%m/%d/%Y')
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return str(value)
+
+def iter_history_csv(entity, wheres, params, chunk_size=200, progress=None):
+	'''
+	Yields the CSV text of the histories one chunk of objects at a time, so the
+	memory used stays the same no matter how many objects match. progress is
+	called with the number of objects written after each chunk.
+	
+	The IDs are found once and read from a server-side cursor. It is held
+	open across the commits that progress may make, but the entity's
+	build_changes() must not close the connection.
+	'''
+	import csv
+	from itertools import islice
+
+	buf = _CSVLineBuffer()
+	writer = csv.writer(buf)
+	writer.writerow(entity.csv_header)
+	yield buf.pop()
+
+	column = entity.id_column
+	rows = iter_changelog_query('%s history ids' % entity.name,
+			'SELECT ' + column + ' FROM (' + entity.get_ids_sql(wheres) +
+			') AS ids ORDER BY ' + column, params, chunk_size, withhold=True)
+	done = 0
+	while True:
+		ids = [_[0] for _ in islice(rows, chunk_size)]
+		if not ids:
+			break
+
+		for object_id, history in get_changes(entity, ids):
+			for row in entity.get_csv_rows(object_id, history):
+				writer.writerow([_encode_csv_value(_) for _ in row])
+		yield buf.pop()
+
+		done += len(ids)
+		if progress:
+			progress(done)
+
+# ==============================================================================
+# ============================ NOTE BASED ENTITIES =============================
+# ==============================================================================
+class NoteHistoryEntity(ChangeHistoryEntity):
+	'''
+	An entity whose history is the "Changed X from ... to ..." system notes
+	that SystemNoteForm writes for it. Subclasses fill in:
+	  * note_column, the notes column that points to the object.
+	  * table, pk_column and label_column of the object's table.
+
+	Each change in the history is one note, with the 'id' and 'entry_date' of
+	the note, its 'lines' from parse_change_lines() and its 'raw_note' text.
+	'''
+	note_column = None
+	table = None
+	pk_column = None
+	label_column = 'name'
+	csv_header = ['ID', 'Date', 'Change', 'Field', 'From', 'To']
+
+	def get_filter_wheres(self, get):
+		from datetime import timedelta
+		import helpers
+
+		wheres = []
+		params = []
+		ids = [_ for _ in get.get('object_id', '').split() if _.isdigit()]
+		if ids:
+			wheres.append('n.' + self.note_column + ' = ANY(%s)')
+			params.append([int(_) for _ in ids])
+
+		if get.get('change_date_start'):
+			wheres.append('n.entry_date >= %s')
+			params.append(helpers.getDate(get['change_date_start']).strftime(
+					'%Y-%m-%d 00:00'))
+
+		if get.get('change_date_end'):
+			wheres.append('n.entry_date < %s')
+			params.append((helpers.getDate(get['change_date_end']) +
+					timedelta(days=1)).strftime('%Y-%m-%d 00:00'))
+
+		return wheres, params
+
+	def _get_notes_where(self):
+		# Finds the object's system notes with the partial indexes made by
+		# add_system_change_flag()
+		return ('n.is_active AND n.' + self.note_column + ' IS NOT NULL AND ' +
+				SYSTEM_NOTE_WHERE)
+
+	def get_ids_sql(self, wheres):
+		where = ' AND '.join([self._get_notes_where()] + wheres)
+		return ('SELECT n.' + self.note_column + ' AS id FROM notes n WHERE ' +
+				where + ' GROUP BY n.' + self.note_column)
+
+	def get_versions(self, ids):
+		# A new or deactivated note changes the count or the last note ID
+		if not ids:
+			return {}
+		cursor = execute_changelog_query('%s history versions' % self.name,
+				'SELECT n.' + self.note_column + ', COUNT(*), MAX(n.notesid) ' +
+				'FROM notes n WHERE ' + self._get_notes_where() + ' AND n.' +
+				self.note_column + ' = ANY(%s) GROUP BY n.' + self.note_column,
+				[[int(_) for _ in ids]])
+		return dict([(i, '%s.%s' % (total, last_note))
+				for i, total, last_note in cursor.fetchall()])
+
+	def build_changes(self, ids):
+		if not ids:
+			return {}
+		cursor = execute_changelog_query('%s history notes' % self.name,
+				'SELECT n.' + self.note_column + ', o.' + self.label_column +
+				', n.notesid, n.entry_date, n.note FROM notes n ' +
+				'JOIN ' + self.table + ' o ON (o.' + self.pk_column + '=n.' +
+				self.note_column + ') WHERE ' + self._get_notes_where() +
+				' AND n.' + self.note_column + ' = ANY(%s) ' +
+				'ORDER BY n.' + self.note_column + ', n.entry_date, n.notesid',
+				[[int(_) for _ in ids]])
+
+		histories = {}
+		for object_id, label, note_id, entry_date, note in cursor.fetchall():
+			lines = parse_change_lines(note)
+			if not lines:
+				continue
+			if object_id not in histories:
+				histories[object_id] = {'label': '%s - %s' % (object_id, label),
+						'changes': []}
+			histories[object_id]['changes'].append({'id': note_id,
+					'entry_date': entry_date, 'lines': lines,
+					'raw_note': get_note_span_text(note)})
+		return histories
+
+	def get_csv_rows(self, object_id, history):
+		rows = []
+		for change in history.get('changes', []):
+			for action, field, old, new in change['lines']:
+				rows.append([object_id, change['entry_date'], action, field,
+						old, new])
+		return rows
+
+# ==============================================================================
+class ProjectHistory(NoteHistoryEntity):
+	name = 'project'
+	note_column = 'project'
+	table = 'projects'
+	pk_column = 'projectsid'
+
+class ProjectTaskHistory(NoteHistoryEntity):
+	name = 'project_task'
+	note_column = 'project_task'
+	table = 'project_tasks'
+	pk_column = 'project_tasksid'
+
+register_entity(ProjectHistory())
+register_entity(ProjectTaskHistory())
@@ -0,0 +1,75 @@
+'''
+The worker for the queued Issue Changelog exports. It is started with the
+run_changelog_export_worker management command and only needs the database,
+which holds the queue in the issue_changelog_export_jobs table.
+'''
+import time
+from datetime import datetime
+from django.db import transaction
+from zt.ver4 import zutil
+from app.historical_note_models import claim_export_job, update_export_job, \
+		fail_stale_export_jobs, expire_export_files
+
+# ==============================================================================
+def run_export_job(job):
+	'''
+	Builds the file for a claimed export job and marks it as done, or as
+	failed with the traceback when something goes wrong.
+	'''
+	from app.historical_note_views import build_issue_history_export
+
+	try:
+		file_path = build_issue_history_export(job)
+	except:
+		error = zutil.get_stack_string()
+		# A failed query leaves the connection's transaction aborted, so it has
+		# to be rolled back before the failure can be saved
+		transaction.rollback()
+		update_export_job(job.pk, status='failed', error=error,
+				finished_at=datetime.now())
+		return False
+
+	update_export_job(job.pk, status='done', file_path=file_path,
+			finished_at=datetime.now())
+	return True
+
+# ==============================================================================
+def run_changelog_export_worker(poll_interval=5, run_once=False,
+		cleanup_interval=60):
+	'''
+	Runs the queued export jobs one at a time. Sleeps for poll_interval seconds
+	when the queue is empty. With run_once it returns once the queue is empty.
+
+	Every cleanup_interval seconds that the queue is empty the jobs left
+	running by a worker that died are failed and the old export files are
+	deleted.
+
+	An error is logged and the worker carries on after poll_interval seconds.
+	A job that it left running is failed by the next cleanup.
+	'''
+	last_cleanup = 0
+	while True:
+		try:
+			job = claim_export_job()
+			if job:
+				run_export_job(job)
+				continue
+
+			if time.time() - last_cleanup >= cleanup_interval:
+				fail_stale_export_jobs()
+				expire_export_files()
+				last_cleanup = time.time()
+		except Exception:
+			transaction.rollback()
+			from helpers import logTraceback
+			traceback = 'Error running the Issue Changelog exports\n\n%s' % (
+					zutil.get_stack_string())
+			logTraceback(traceback, 'run_changelog_export_worker')
+			if run_once:
+				return
+			time.sleep(poll_interval)
+			continue
+
+		if run_once:
+			return
+		time.sleep(poll_interval)
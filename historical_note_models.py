@@ -0,0 +1,1124 @@
+'''
+Models and write-time hooks for the Issue Changelog.
+
+app/models.py imports this module so that the models are picked up by syncdb
+and the signal handlers below are connected for every process.
+'''
+import time
+import threading
+from django.conf import settings
+from django.db import models, transaction, connection
+from django.db.models.signals import post_save
+from app.models import Issue, Note, Email, Reply, IssueProject, IssueType, \
+		IssueDisposition, Person
+from django.contrib.auth.models import User
+from helpers import getFieldItem
+from app.note_change_parser import parse_note, parse_email_subject_title
+
+# The issue fields tracked by the changelog. The order matches the columns
+# returned by get_source_change_rows().
+CHANGELOG_FIELDS = ['title', 'project', 'issue_type', 'issue_disposition',
+		'reported_by', 'tickets']
+
+# The columns of a changelog row, as returned by get_source_change_rows(),
+# followed by the history_* values that the changelog fills in.
+CHANGELOG_COLUMNS = ['type', 'id', 'entry_date', 'category', 'issue_id',
+		'changed_title', 'current_title',
+		'changed_project', 'current_project',
+		'changed_issue_type', 'current_issue_type',
+		'changed_issue_disposition', 'current_issue_disposition',
+		'changed_reported_by', 'current_reported_by',
+		'changed_tickets', 'current_tickets',
+		'note_type', 'change_date', 'raw_note']
+CHANGELOG_ROW_KEYS = CHANGELOG_COLUMNS + ['history_%s' % _ for _ in CHANGELOG_FIELDS]
+CHANGELOG_ROW_INDEX = dict([(k, i) for i, k in enumerate(CHANGELOG_ROW_KEYS)])
+
+# ==============================================================================
+class ChangelogRow(object):
+	'''
+	One note or email in the changelog. The values are kept in a single list
+	in CHANGELOG_ROW_KEYS order instead of a dictionary per row, but the row
+	can still be read like the dictionaries the templates and exports expect.
+	'''
+	__slots__ = ('values',)
+
+	def __init__(self, values):
+		self.values = values
+
+	def __getitem__(self, key):
+		return self.values[CHANGELOG_ROW_INDEX[key]]
+
+	def __setitem__(self, key, value):
+		self.values[CHANGELOG_ROW_INDEX[key]] = value
+
+	def __contains__(self, key):
+		return key in CHANGELOG_ROW_INDEX
+
+	def get(self, key, default=None):
+		i = CHANGELOG_ROW_INDEX.get(key, None)
+		if i is None:
+			return default
+		return self.values[i]
+
+	def keys(self):
+		return list(CHANGELOG_ROW_KEYS)
+
+	def items(self):
+		return zip(CHANGELOG_ROW_KEYS, self.values)
+
+	# Needed to pickle the rows into the cache since there is no __dict__
+	def __getstate__(self):
+		return self.values
+
+	def __setstate__(self, values):
+		self.values = values
+
+# ==============================================================================
+class IssueChangeEvent(models.Model):
+	'''
+	A single field change on an Issue, taken from a system note or an email.
+	Rows are written when a note, email or reply is saved and by
+	backfill_issue_change_events() for the data that existed beforehand.
+	'''
+	id = models.AutoField(primary_key=True, db_column='issue_change_eventsid')
+	issue = models.ForeignKey(Issue, db_column='issue')
+	field = models.CharField(max_length=32)
+	old_value = models.TextField(null=True, blank=True)
+	new_value = models.TextField(null=True, blank=True)
+	# The ID of the IssueProject, IssueType, IssueDisposition or Person that
+	# new_value names. This is what the changelog filters are matched on.
+	new_value_id = models.IntegerField(null=True, blank=True)
+	change_date = models.DateTimeField()
+	note = models.ForeignKey(Note, db_column='note', null=True, blank=True)
+	email = models.ForeignKey(Email, db_column='email', null=True, blank=True)
+
+	class Meta:
+		app_label = 'app'
+		db_table = 'issue_change_events'
+		ordering = ['issue', 'change_date', 'id']
+
+	def __unicode__(self):
+		return u'#%s %s: %s -> %s' % (self.issue_id, self.field,
+				self.old_value, self.new_value)
+
+# ==============================================================================
+class IssueChangelogVersion(models.Model):
+	'''
+	Goes up every time the changelog of an Issue is rebuilt so cached copies
+	of it can be told apart from the current one.
+	'''
+	issue = models.OneToOneField(Issue, primary_key=True, db_column='issue')
+	version = models.IntegerField(default=1)
+
+	class Meta:
+		app_label = 'app'
+		db_table = 'issue_changelog_versions'
+
+# ==============================================================================
+class IssueFirstNote(models.Model):
+	'''
+	The date of the first note of each Issue. Only emails sent before it show
+	up in the changelog. Kept up to date by update_issue_first_notes().
+	'''
+	issue = models.OneToOneField(Issue, primary_key=True, db_column='issue')
+	first_note_at = models.DateTimeField()
+
+	class Meta:
+		app_label = 'app'
+		db_table = 'issue_first_notes'
+
+# ==============================================================================
+class IssueStateSnapshot(models.Model):
+	'''
+	The values of an Issue's changelog fields after one of its change events.
+	One is saved every ISSUE_CHANGELOG_SNAPSHOT_EVERY events so get_issue_state()
+	only has to replay the events after the nearest one. Rebuilt along with
+	the Issue's change events.
+	'''
+	id = models.AutoField(primary_key=True, db_column='issue_state_snapshotsid')
+	issue = models.ForeignKey(Issue, db_column='issue')
+	# The change_date and ID of the last event that the snapshot includes
+	taken_at = models.DateTimeField()
+	last_event = models.IntegerField()
+	title = models.TextField(blank=True)
+	project = models.TextField(blank=True)
+	issue_type = models.TextField(blank=True)
+	issue_disposition = models.TextField(blank=True)
+	reported_by = models.TextField(blank=True)
+	tickets = models.TextField(blank=True)
+
+	class Meta:
+		app_label = 'app'
+		db_table = 'issue_state_snapshots'
+		ordering = ['issue', 'taken_at', 'last_event']
+
+# ==============================================================================
+class IssueChangelogExportJob(models.Model):
+	'''
+	A changelog export queued from the Issue Changelog page. The export worker
+	picks up the queued jobs, writes the file and updates the progress that the
+	page polls for.
+	'''
+	STATUS_CHOICES = (
+		('queued', 'Queued'),
+		('running', 'Running'),
+		('done', 'Done'),
+		('failed', 'Failed'),
+		# The file was deleted by expire_export_files()
+		('expired', 'Expired'),
+	)
+	id = models.AutoField(primary_key=True,
+			db_column='issue_changelog_export_jobsid')
+	# The urlencoded GET data of the Issue Changelog filter form
+	filters = models.TextField(blank=True)
+	created_by = models.ForeignKey(User, db_column='created_by')
+	status = models.CharField(max_length=16, choices=STATUS_CHOICES,
+			default='queued', db_index=True)
+	total_issues = models.IntegerField(default=0)
+	done_issues = models.IntegerField(default=0)
+	file_path = models.CharField(max_length=255, blank=True)
+	error = models.TextField(blank=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+	started_at = models.DateTimeField(null=True, blank=True)
+	finished_at = models.DateTimeField(null=True, blank=True)
+
+	class Meta:
+		app_label = 'app'
+		db_table = 'issue_changelog_export_jobs'
+		ordering = ['id']
+
+# ==============================================================================
+@transaction.commit_on_success
+def claim_export_job():
+	'''
+	Marks the oldest queued export job as running and returns it, or None when
+	nothing is queued. Locked rows are skipped so several workers can share
+	the queue.
+	'''
+	cursor = connection.cursor()
+	cursor.execute('''
+	UPDATE issue_changelog_export_jobs SET status='running', started_at=now()
+	WHERE issue_changelog_export_jobsid = (
+		SELECT issue_changelog_export_jobsid FROM issue_changelog_export_jobs
+		WHERE status='queued'
+		ORDER BY issue_changelog_export_jobsid
+		LIMIT 1
+		FOR UPDATE SKIP LOCKED)
+	RETURNING issue_changelog_export_jobsid
+	''', [])
+	row = cursor.fetchone()
+	if not row:
+		return None
+	return IssueChangelogExportJob.objects.get(pk=row[0])
+
+@transaction.commit_on_success
+def update_export_job(job_id, **fields):
+	# Saves the job's fields right away so the progress can be polled
+	IssueChangelogExportJob.objects.filter(pk=job_id).update(**fields)
+
+@transaction.commit_on_success
+def fail_stale_export_jobs(timeout=None):
+	'''
+	Marks the jobs that have been running for longer than timeout seconds
+	(ISSUE_CHANGELOG_EXPORT_TIMEOUT, two hours by default) as failed. Their
+	worker is taken to have died, and the page polling for them gets the
+	failure instead of waiting forever. Returns the number of jobs failed.
+	'''
+	from datetime import datetime, timedelta
+	
+	if timeout is None:
+		timeout = getattr(settings, 'ISSUE_CHANGELOG_EXPORT_TIMEOUT', 60*60*2)
+	now = datetime.now()
+	return IssueChangelogExportJob.objects.filter(status='running',
+			started_at__lt=now - timedelta(seconds=timeout)).update(
+			status='failed', finished_at=now,
+			error='The export worker stopped before the export was finished.')
+
+@transaction.commit_on_success
+def expire_export_files(max_age=None):
+	'''
+	Deletes the files of the exports that finished more than max_age seconds
+	ago (ISSUE_CHANGELOG_EXPORT_MAX_AGE, a week by default) and marks their
+	jobs as expired. Returns the number of jobs expired.
+	'''
+	import os
+	from datetime import datetime, timedelta
+	
+	if max_age is None:
+		max_age = getattr(settings, 'ISSUE_CHANGELOG_EXPORT_MAX_AGE',
+				60*60*24*7)
+	jobs = IssueChangelogExportJob.objects.filter(status='done',
+			finished_at__lt=datetime.now() - timedelta(seconds=max_age))
+	
+	expired = 0
+	for job in jobs:
+		if job.file_path and os.path.exists(job.file_path):
+			os.remove(job.file_path)
+		expired += IssueChangelogExportJob.objects.filter(pk=job.pk).update(
+				status='expired', file_path='')
+	return expired
+
+# ==============================================================================
+class ChangelogQueryLog(models.Model):
+	'''
+	Timing (and optionally the EXPLAIN ANALYZE plan) of one changelog query.
+	Only written while a query profile is running, see start_query_profile().
+	All of the queries run for one page request share the same request_key.
+	'''
+	id = models.AutoField(primary_key=True,
+			db_column='issue_changelog_query_logsid')
+	request_key = models.CharField(max_length=32, db_index=True)
+	name = models.CharField(max_length=64)
+	query_hash = models.CharField(max_length=32)
+	param_count = models.IntegerField(default=0)
+	wall_ms = models.FloatField(default=0)
+	row_count = models.IntegerField(default=0)
+	explain = models.TextField(blank=True)
+	created_by = models.ForeignKey(User, db_column='created_by', null=True,
+			blank=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	class Meta:
+		app_label = 'app'
+		db_table = 'issue_changelog_query_logs'
+		ordering = ['id']
+
+# ==============================================================================
+# ============================= QUERY PROFILING ================================
+# ==============================================================================
+_query_profile = threading.local()
+
+def start_query_profile(request_key, explain=False, user=None):
+	'''
+	Starts logging every changelog query run by this thread to the
+	issue_changelog_query_logs table under request_key. With explain the
+	EXPLAIN (ANALYZE, BUFFERS) output is saved too, which runs each query twice.
+	'''
+	_query_profile.current = {'request_key': request_key, 'explain': explain,
+			'user': user}
+
+def stop_query_profile():
+	_query_profile.current = None
+
+def is_query_profile_running():
+	return getattr(_query_profile, 'current', None) is not None
+
+def _explain_changelog_query(profile, sql, params):
+	# The EXPLAIN (ANALYZE, BUFFERS) output of a query when the profile asks
+	# for it. ANALYZE runs the query, so it is done on a cursor of its own.
+	if not profile['explain'] or sql.lstrip().upper().startswith('EXPLAIN'):
+		return ''
+	cursor = connection.cursor()
+	cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+	return '\n'.join([_[0] for _ in cursor.fetchall()])
+
+def _log_changelog_query(profile, name, sql, params, wall_ms, row_count,
+		explain):
+	import hashlib
+	ChangelogQueryLog(request_key=profile['request_key'], name=name,
+			query_hash=hashlib.md5(sql).hexdigest(), param_count=len(params),
+			wall_ms=wall_ms, row_count=row_count, explain=explain,
+			created_by=profile['user']).save()
+
+def execute_changelog_query(name, sql, params):
+	'''
+	Runs a changelog query and returns the cursor. While a query profile is
+	running the query's hash, parameter count, time and row count are logged.
+	'''
+	cursor = connection.cursor()
+	profile = getattr(_query_profile, 'current', None)
+	if not profile:
+		cursor.execute(sql, params)
+		return cursor
+
+	explain = _explain_changelog_query(profile, sql, params)
+
+	start = time.time()
+	cursor.execute(sql, params)
+	wall_ms = (time.time() - start) * 1000
+
+	_log_changelog_query(profile, name, sql, params, wall_ms, cursor.rowcount,
+			explain)
+	return cursor
+
+def iter_changelog_query(name, sql, params, batch_size=1000, withhold=False):
+	'''
+	Runs a changelog query on a named (server-side) cursor and yields its rows.
+	Only batch_size rows are fetched from the database at a time. The rows have
+	to be read before the transaction ends, unless withhold is set to keep the
+	cursor open across commits.
+
+	The time is spent in the fetches as much as in the execute, so the time
+	that is logged, to the query profile or to connection.queries with DEBUG
+	on, is the execute and the fetches together. It is logged once the cursor
+	is closed, with the number of rows that were read.
+	'''
+	import uuid
+	
+	profile = getattr(_query_profile, 'current', None)
+	explain = profile and _explain_changelog_query(profile, sql, params)
+
+	# Make sure the connection is open before asking it for a named cursor
+	connection.cursor()
+	cursor = connection.connection.cursor('changelog_%s' % uuid.uuid4().hex,
+			withhold=withhold)
+	query_time = 0
+	row_count = 0
+	failed = False
+	try:
+		start = time.time()
+		cursor.execute(sql, params)
+		query_time += time.time() - start
+		while True:
+			start = time.time()
+			rows = cursor.fetchmany(batch_size)
+			query_time += time.time() - start
+			if not rows:
+				break
+			row_count += len(rows)
+			for row in rows:
+				yield row
+	except Exception:
+		# The transaction may be aborted, so nothing more is logged
+		failed = True
+		raise
+	finally:
+		cursor.close()
+		if settings.DEBUG:
+			connection.queries.append({'sql': '%s: %s' % (name, sql),
+					'time': '%.3f' % query_time})
+		if profile and not failed:
+			_log_changelog_query(profile, name, sql, params, query_time * 1000,
+					row_count, explain)
+
+# ==============================================================================
+_CHANGED_FIELD_INDEXES = [CHANGELOG_COLUMNS.index('changed_%s' % _)
+		for _ in CHANGELOG_FIELDS]
+_CHANGED_TITLE_INDEX = CHANGELOG_COLUMNS.index('changed_title')
+_CHANGED_REPORTED_BY_INDEX = CHANGELOG_COLUMNS.index('changed_reported_by')
+_RAW_NOTE_INDEX = CHANGELOG_COLUMNS.index('raw_note')
+
+# Finds the system notes, the "Changed X from ... to ..." notes that the forms
+# write. The notes.is_system_change flag is set by the forms and by
+# backfill_system_change_notes. Turn the ISSUE_CHANGELOG_USE_SYSTEM_FLAG
+# setting on once that has been run on a database; until then the notes' text
+# is searched. Either way it is used in queries that take parameters.
+if getattr(settings, 'ISSUE_CHANGELOG_USE_SYSTEM_FLAG', False):
+	SYSTEM_NOTE_WHERE = 'n.is_system_change'
+else:
+	SYSTEM_NOTE_WHERE = "n.note ILIKE '%%<span%%'"
+
+# The keys that the duplicate notes and emails are thrown out by. They start
+# with the Issue so that the same note on several Issues at once (like a bulk
+# disposition change) is kept on each of them. The stored
+# copies are kept up to date by the triggers that add_changelog_dedupe_keys()
+# creates, and have indexes in the same order as the queries' DISTINCT ON.
+# The columns only exist once backfill_changelog_dedupe_keys has run, so turn
+# ISSUE_CHANGELOG_USE_DEDUPE_KEYS on after that. Until then the keys are
+# worked out in the queries.
+if getattr(settings, 'ISSUE_CHANGELOG_USE_DEDUPE_KEYS', False):
+	_NOTE_DEDUPE_KEYS = 'n.issue, n.entry_minute, n.note_hash'
+	_EMAIL_DAY = 'e.add_day'
+else:
+	_NOTE_DEDUPE_KEYS = "n.issue, date_trunc('minute', n.entry_date), md5(n.note)"
+	_EMAIL_DAY = "date_trunc('day', e.add_date)"
+
+# Only the start of each email's body is read with the changelog rows. The
+# whole bodies are read by get_email_bodies() when they are needed.
+EMAIL_PREVIEW_LENGTH = int(getattr(settings, 'ISSUE_CHANGELOG_EMAIL_PREVIEW', 200))
+
+# The system notes and the emails of the Issues in the parameter, as changelog
+# rows before the notes are parsed. See get_source_change_rows().
+_SOURCE_NOTE_ROWS_SQL = """
+	SELECT DISTINCT ON (""" + _NOTE_DEDUPE_KEYS + """) 'note' as type, n.notesid as id, n.entry_date, n.category, n.issue AS "issue_id",
+					'' AS "changed_title", i.title AS "current_title",
+					'' AS "changed_project", ip.name AS "current_project",
+					'' AS "changed_issue_type", it.type AS "current_issue_type",
+					'' AS "changed_issue_disposition", id.disposition AS "current_issue_disposition",
+					CASE WHEN p.peopleid IS NOT NULL THEN (COALESCE(p.last_name, '') || ', ' || COALESCE(p.first_name, '')) ELSE '' END AS "changed_reported_by", CASE WHEN p2.peopleid IS NOT NULL THEN (COALESCE(p2.last_name, '') || ', ' || COALESCE(p2.first_name, '')) ELSE '' END AS "current_reported_by",
+					'' AS "changed_tickets", COALESCE(i.tickets, '') AS "current_tickets",
+					nt.type AS "note_type",
+					n.entry_date AS "change_date",
+					n.note AS "raw_note"
+	FROM notes n
+	JOIN issues i ON (n.issue=i.issuesid)
+	LEFT JOIN issue_dispositions id ON (id.issue_dispositionsid=i.issue_disposition)
+	LEFT JOIN people p ON (p.peopleid=n.issue_person)
+	LEFT JOIN people p2 ON (p2.peopleid=i.person)
+	LEFT JOIN note_types nt ON (nt.note_typesid=n.type)
+	LEFT JOIN note_categories nc ON (nc.note_categoriesid=n.category)
+	LEFT JOIN auth_user au ON (au.id=n.created_by)
+	LEFT JOIN issue_projects ip ON (ip.issue_projectsid=i.issue_projectsid)
+	LEFT JOIN issue_types it ON (it.issue_typesid=i.issue_type)
+	WHERE n.is_active AND n.issue = ANY(%s)
+		AND """ + SYSTEM_NOTE_WHERE + """
+	ORDER BY """ + _NOTE_DEDUPE_KEYS + """, n.category, n.notesid
+	"""
+
+_SOURCE_EMAIL_ROWS_SQL = """
+	SELECT DISTINCT ON(data.issue,data.add_day) 'email' as type, data.emailsid as id, data.add_date, null as category, data.issue AS "issue_id",
+                data.subject AS "changed_title",
+                data.title AS "current_title",
+                'ledsSuite' AS "changed_project",
+                data.name AS "current_project",
+                'Incident' AS "changed_issue_type",
+                data.type AS "current_issue_type",
+                'In Support' AS "changed_issue_disposition",
+                data.disposition AS "current_issue_disposition",
+                CASE WHEN data.people_id_1 IS NOT NULL THEN (COALESCE(data.last_name_1, '') || ', ' || COALESCE(data.first_name_1, ''))  ELSE '' END AS "changed_reported_by",
+                CASE WHEN data.people_id_2 IS NOT NULL THEN (COALESCE(data.last_name_2, '') || ', ' || COALESCE(data.first_name_2, '')) ELSE '' END AS "current_reported_by",
+                '' AS "changed_tickets",
+                COALESCE(data.tickets, '') AS "current_tickets",
+                'Email' AS "note_type",
+                data.add_date AS "change_date",
+                data.body AS "raw_note"
+
+				FROM
+				(SELECT
+				   e.emailsid,e.add_date,""" + _EMAIL_DAY + """ AS add_day,e.subject,left(e.body, """ + str(EMAIL_PREVIEW_LENGTH) + """) AS body,e.issue,i.title,i.tickets,
+				   p.last_name as last_name_1,p.peopleid as people_id_1,p.first_name as first_name_1,
+				   p2.peopleid as people_id_2,p2.last_name as last_name_2,
+				   p2.first_name as first_name_2,id.disposition,it.type,ip.name
+				FROM emails e
+				JOIN issues i ON (e.issue=i.issuesid)
+				JOIN replies r ON (r.email = e.emailsid)
+				JOIN issue_first_notes fn ON (fn.issue=e.issue)
+				LEFT JOIN email_addresses ea ON (ea.email_addressesid=r.email_address)
+				LEFT JOIN people p ON (ea.person=p.peopleid)
+				LEFT JOIN people p2 ON (p2.peopleid=i.person)
+				LEFT JOIN issue_dispositions id ON (id.issue_dispositionsid=i.issue_disposition)
+				LEFT JOIN issue_projects ip ON (ip.issue_projectsid=i.issue_projectsid)
+				LEFT JOIN issue_types it ON (it.issue_typesid=i.issue_type)
+				WHERE e.is_active
+				AND e.issue = ANY(%s)
+				AND e.add_date < fn.first_note_at
+				  ) AS data
+				  ORDER BY data.issue,data.add_day
+	"""
+
+# Both halves in one query. The first parameter is for the notes and the
+# second for the emails.
+_SOURCE_CHANGE_ROWS_SQL = ('(' + _SOURCE_NOTE_ROWS_SQL + ') UNION ALL (' +
+		_SOURCE_EMAIL_ROWS_SQL + ') ORDER BY 5, 3, 2, 4')
+
+# ==============================================================================
+def get_source_change_rows(issueids, concurrent=False):
+	'''
+	Parses the system notes and the emails of the given Issues into changelog
+	rows. This is the expensive query that the issue_change_events table
+	stores the results of.
+	
+	With concurrent the notes and the emails are queried at the same time on
+	two connections of their own and merged here. Those connections can't see
+	anything this transaction hasn't committed yet, so it is only for reads.
+
+	Returns the column names and the rows ordered by issue, date and id.
+	'''
+	# The IDs are bound as an array parameter instead of being formatted into
+	# an IN list. psycopg2 still writes them into the statement as ARRAY[...],
+	# so the query text grows with the number of Issues. See
+	# benchmark_issue_id_binding() for what that costs.
+	issueids = [int(_) for _ in issueids]
+	
+	if concurrent:
+		return CHANGELOG_COLUMNS, list(_merge_source_halves(issueids))
+
+	cursor = execute_changelog_query('source change rows',
+			_SOURCE_CHANGE_ROWS_SQL, [issueids, issueids])
+
+	return CHANGELOG_COLUMNS, [_parse_source_row(_) for _ in cursor.fetchall()]
+
+def iter_source_change_rows(issueids, batch_size=1000):
+	'''
+	Yields the same rows as get_source_change_rows() from a server-side
+	cursor, batch_size rows at a time, so that every email body doesn't have to
+	be held in memory at once.
+	'''
+	issueids = [int(_) for _ in issueids]
+	for row in iter_changelog_query('source change rows',
+			_SOURCE_CHANGE_ROWS_SQL, [issueids, issueids], batch_size):
+		yield _parse_source_row(row)
+
+def _fetch_source_half(sql, issueids):
+	# Runs on a thread of its own, which gets its own database connection
+	try:
+		cursor = connection.cursor()
+		cursor.execute('SELECT * FROM (' + sql + ') AS half ORDER BY 5, 3, 2, 4',
+				[issueids])
+		return [_parse_source_row(_) for _ in cursor.fetchall()]
+	finally:
+		connection.close()
+
+def _source_row_sort_key(row):
+	# The query's "ORDER BY 5, 3, 2, 4", with the NULL categories last
+	return (row[4], row[2], row[1], row[3] is None, row[3])
+
+def _merge_source_halves(issueids):
+	'''
+	Queries the notes and the emails halves of the source rows at the same time
+	and yields the rows of both in the same order as the UNION ALL query. Each
+	half comes back sorted, so they are merged as they are read instead of
+	being sorted again.
+	'''
+	import heapq
+	from multiprocessing.pool import ThreadPool
+	
+	pool = ThreadPool(2)
+	try:
+		results = [pool.apply_async(_fetch_source_half, (sql, issueids))
+				for sql in (_SOURCE_NOTE_ROWS_SQL, _SOURCE_EMAIL_ROWS_SQL)]
+		halves = [_.get() for _ in results]
+	finally:
+		pool.close()
+		pool.join()
+		
+	for key, row in heapq.merge(*[_decorate_source_half(half, n)
+			for n, half in enumerate(halves)]):
+		yield row
+
+def _decorate_source_half(half, n):
+	# The half's number and the row's position break any ties so the rows
+	# themselves are never compared
+	for i, row in enumerate(half):
+		yield (_source_row_sort_key(row), n, i), row
+
+def _parse_source_row(row):
+	# The notes and subjects come back raw and are parsed here, on the web
+	# worker, rather than with substring() in the query.
+	row = list(row)
+	if row[0] == 'note':
+		parsed = parse_note(row[_RAW_NOTE_INDEX])
+		for i, index in enumerate(_CHANGED_FIELD_INDEXES):
+			if index == _CHANGED_REPORTED_BY_INDEX and parsed[i] is None:
+				# The SQL fell back to the note's person
+				continue
+			row[index] = parsed[i] or ''
+		row[_RAW_NOTE_INDEX] = parsed[-1]
+	else:
+		row[_CHANGED_TITLE_INDEX] = parse_email_subject_title(
+				row[_CHANGED_TITLE_INDEX])
+	return tuple(row)
+
+# ==============================================================================
+def record_issue_change_events(issueids):
+	'''
+	Rebuilds the issue_change_events rows for the given Issues from their notes
+	and emails. The whole Issue is redone since a new or deactivated note can
+	change which emails and duplicate notes count as changes.
+	'''
+	issueids = [int(_) for _ in issueids]
+	if not issueids:
+		return 0
+
+	cols, rows = get_source_change_rows(issueids)
+
+	events = []
+	prev_values = {}
+	value_ids = {}
+	for row in rows:
+		row = dict(zip(cols, row))
+		if row['issue_id'] != prev_values.get('issue_id'):
+			prev_values = {'issue_id': row['issue_id']}
+
+		note_id = email_id = None
+		if row['type'] == 'note':
+			note_id = row['id']
+		else:
+			email_id = row['id']
+
+		for f in CHANGELOG_FIELDS:
+			new_value = row['changed_%s' % f]
+			if not new_value:
+				continue
+			events.append((row['issue_id'], f, prev_values.get(f, None),
+					new_value, _get_value_id(f, new_value, value_ids),
+					row['entry_date'], note_id, email_id))
+			prev_values[f] = new_value
+
+	cursor = connection.cursor()
+	cursor.execute('DELETE FROM issue_change_events WHERE issue = ANY(%s)',
+			[issueids])
+	if events:
+		cursor.executemany('''
+		INSERT INTO issue_change_events (issue, field, old_value, new_value,
+			new_value_id, change_date, note, email)
+		VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+		''', events)
+
+	_rebuild_issue_state_snapshots(issueids)
+	_bump_issue_changelog_versions(issueids)
+	return len(events)
+
+# ==============================================================================
+def get_email_bodies(emailids):
+	'''
+	Returns a dictionary of the whole bodies of the given emails. The
+	changelog rows only have the first EMAIL_PREVIEW_LENGTH characters.
+	'''
+	if not emailids:
+		return {}
+	cursor = connection.cursor()
+	cursor.execute('SELECT emailsid, body FROM emails WHERE emailsid = ANY(%s)',
+			[[int(_) for _ in emailids]])
+	return dict(cursor.fetchall())
+
+def load_email_bodies(changes):
+	# Replaces the body previews of the email rows with the whole bodies
+	bodies = get_email_bodies([_['id'] for _ in changes if _['type'] == 'email'])
+	for row in changes:
+		if row['type'] == 'email':
+			row['raw_note'] = bodies.get(row['id'], row['raw_note'])
+
+# ==============================================================================
+# ============================== ISSUE STATE ===================================
+# ==============================================================================
+def apply_issue_change(state, field, value):
+	'''
+	Applies a changed value to an Issue's state, a dictionary of the
+	CHANGELOG_FIELDS. Blank values aren't changes and "None" means the value
+	was removed.
+	'''
+	if not value:
+		return
+	if value.lower() == 'none':
+		state[field] = ''
+	else:
+		state[field] = value.strip()
+
+def _rebuild_issue_state_snapshots(issueids):
+	# Replays the Issues' change events and saves a snapshot every so often
+	every = getattr(settings, 'ISSUE_CHANGELOG_SNAPSHOT_EVERY', 50)
+
+	cursor = connection.cursor()
+	cursor.execute('DELETE FROM issue_state_snapshots WHERE issue = ANY(%s)',
+			[issueids])
+	cursor.execute('''
+	SELECT issue_change_eventsid, issue, field, new_value, change_date
+	FROM issue_change_events WHERE issue = ANY(%s)
+	ORDER BY issue, change_date, issue_change_eventsid
+	''', [issueids])
+
+	snapshots = []
+	state = {}
+	total = 0
+	prev_issue = None
+	for event_id, issue_id, field, value, change_date in cursor.fetchall():
+		if issue_id != prev_issue:
+			state = {}
+			total = 0
+			prev_issue = issue_id
+		apply_issue_change(state, field, value)
+		total += 1
+		if total % every == 0:
+			snapshots.append([issue_id, change_date, event_id] +
+					[state.get(_, '') for _ in CHANGELOG_FIELDS])
+
+	if snapshots:
+		cursor.executemany('''
+		INSERT INTO issue_state_snapshots (issue, taken_at, last_event, ''' +
+				', '.join(CHANGELOG_FIELDS) + ''')
+		VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+		''', snapshots)
+
+def get_issue_state(issue_id, at=None):
+	'''
+	Returns a dictionary of the Issue's CHANGELOG_FIELDS values as of the given
+	datetime (now by default), according to its changelog. Values that had
+	never been set are blank. Starts from the nearest snapshot before the time
+	and only replays the change events after it.
+	'''
+	if at is None:
+		from datetime import datetime
+		at = datetime.now()
+
+	cursor = connection.cursor()
+	cursor.execute('''
+	SELECT taken_at, last_event, ''' + ', '.join(CHANGELOG_FIELDS) + '''
+	FROM issue_state_snapshots WHERE issue=%s AND taken_at <= %s
+	ORDER BY taken_at DESC, last_event DESC LIMIT 1
+	''', [issue_id, at])
+	snapshot = cursor.fetchone()
+
+	state = {}
+	sql = '''
+	SELECT field, new_value FROM issue_change_events
+	WHERE issue=%s AND change_date <= %s'''
+	params = [issue_id, at]
+	if snapshot:
+		state = dict(zip(CHANGELOG_FIELDS, snapshot[2:]))
+		sql += ' AND (change_date, issue_change_eventsid) > (%s, %s)'
+		params += [snapshot[0], snapshot[1]]
+	cursor.execute(sql + ' ORDER BY change_date, issue_change_eventsid', params)
+
+	for field, value in cursor.fetchall():
+		apply_issue_change(state, field, value)
+	return dict([(_, state.get(_, '')) for _ in CHANGELOG_FIELDS])
+
+# ==============================================================================
+def _bump_issue_changelog_versions(issueids):
+	# Invalidates any cached changelogs for the Issues
+	cursor = connection.cursor()
+	cursor.execute('''
+	UPDATE issue_changelog_versions SET version=version+1 WHERE issue = ANY(%s)
+	''', [issueids])
+	cursor.execute('''
+	INSERT INTO issue_changelog_versions (issue, version)
+	SELECT i.issuesid, 1 FROM issues i
+	WHERE i.issuesid = ANY(%s) AND NOT EXISTS (
+		SELECT 1 FROM issue_changelog_versions v WHERE v.issue=i.issuesid)
+	''', [issueids])
+
+def get_issue_changelog_versions(issueids):
+	'''
+	Returns a dictionary of the changelog versions of the given Issues. Issues
+	that have never had their changelog built are left out.
+	'''
+	if not issueids:
+		return {}
+	cursor = connection.cursor()
+	cursor.execute('''
+	SELECT issue, version FROM issue_changelog_versions WHERE issue = ANY(%s)
+	''', [[int(_) for _ in issueids]])
+	return dict(cursor.fetchall())
+
+# ==============================================================================
+def _get_value_id(field, value, value_ids):
+	'''
+	Returns the ID of the object that the changed value names, or None when
+	the field doesn't reference an object or no object matches. value_ids
+	caches the lookups for the fields and values already seen.
+	'''
+	value = value.strip()
+	key = (field, value.lower())
+	if key in value_ids:
+		return value_ids[key]
+
+	objs = []
+	if field == 'project':
+		objs = IssueProject.objects.filter(name__iexact=value)
+	elif field == 'issue_type':
+		objs = IssueType.objects.filter(type__iexact=value)
+	elif field == 'issue_disposition':
+		objs = IssueDisposition.objects.filter(disposition__iexact=value)
+	elif field == 'reported_by' and value:
+		# People show up as either "Last, First" or "First Last"
+		if ',' in value:
+			last, first = [_.strip() for _ in value.split(',', 1)]
+		else:
+			first, last = (value.split(None, 1) + [''])[:2]
+		objs = Person.objects.filter(first_name__iexact=first,
+				last_name__iexact=last)
+
+	value_ids[key] = getFieldItem(objs, ['pk'], None, 0)
+	return value_ids[key]
+
+# ==============================================================================
+def update_issue_first_notes(issueids=None):
+	'''
+	Recalculates the first note date of the given Issues, or of every Issue
+	when no IDs are given.
+	'''
+	where = ''
+	params = []
+	if issueids is not None:
+		if not issueids:
+			return
+		where = 'WHERE issue = ANY(%s)'
+		params = [[int(_) for _ in issueids]]
+
+	cursor = connection.cursor()
+	cursor.execute('DELETE FROM issue_first_notes ' + where, params)
+	cursor.execute('''
+	INSERT INTO issue_first_notes (issue, first_note_at)
+	SELECT issue, MIN(entry_date) FROM notes
+	''' + where + '''
+	GROUP BY issue
+	HAVING issue IS NOT NULL
+	''', params)
+
+# ==============================================================================
+@transaction.commit_on_success
+def _backfill_issue_chunk(issueids):
+	return record_issue_change_events(issueids)
+
+def backfill_issue_change_events(chunk_size=500, start_issue=0):
+	'''
+	Fills the issue_change_events table for every Issue that has notes or emails.
+	Each chunk of Issues is committed on its own so the backfill can be stopped
+	and restarted with start_issue set to the last Issue ID printed.
+	'''
+	# The emails in the changelog depend on the first note dates
+	transaction.commit_on_success(update_issue_first_notes)()
+
+	cursor = connection.cursor()
+	cursor.execute('''
+	SELECT issue FROM notes WHERE issue IS NOT NULL AND issue > %s
+	UNION
+	SELECT issue FROM emails WHERE issue IS NOT NULL AND issue > %s
+	ORDER BY 1
+	''', [start_issue, start_issue])
+	issueids = [_[0] for _ in cursor.fetchall()]
+
+	total_events = 0
+	for i in range(0, len(issueids), chunk_size):
+		chunk = issueids[i:i+chunk_size]
+		total_events += _backfill_issue_chunk(chunk)
+		yield chunk[-1], total_events
+
+# ==============================================================================
+def add_system_change_flag():
+	'''
+	Adds the notes.is_system_change column and its partial indexes, which the
+	changelog and the Project and Project Task histories use to find the
+	system notes. Safe to run more than once.
+	'''
+	cursor = connection.cursor()
+	cursor.execute('''
+	ALTER TABLE notes ADD COLUMN IF NOT EXISTS is_system_change boolean
+		NOT NULL DEFAULT false
+	''')
+	cursor.execute('''
+	CREATE INDEX IF NOT EXISTS notes_system_change_issue_idx
+		ON notes (issue, entry_date) WHERE is_system_change AND is_active
+	''')
+	cursor.execute('''
+	CREATE INDEX IF NOT EXISTS notes_system_change_project_idx
+		ON notes (project, entry_date) WHERE is_system_change AND is_active
+	''')
+	cursor.execute('''
+	CREATE INDEX IF NOT EXISTS notes_system_change_project_task_idx
+		ON notes (project_task, entry_date) WHERE is_system_change AND is_active
+	''')
+
+def flag_system_change_notes(noteids):
+	# Marks the notes as system notes
+	cursor = connection.cursor()
+	cursor.execute('UPDATE notes SET is_system_change=true WHERE notesid = ANY(%s)',
+			[[int(_) for _ in noteids]])
+
+@transaction.commit_on_success
+def _backfill_system_change_chunk(first_note, last_note):
+	# The same test that the changelog queries used before the flag
+	cursor = connection.cursor()
+	cursor.execute('''
+	UPDATE notes SET is_system_change=true
+	WHERE notesid > %s AND notesid <= %s AND NOT is_system_change
+		AND note ILIKE '%%<span%%'
+	''', [first_note, last_note])
+	return cursor.rowcount
+
+def backfill_system_change_notes(chunk_size=10000, start_note=0):
+	'''
+	Sets is_system_change on the existing system notes, adding the column
+	first if it isn't there. Yields the last note ID and the number of notes
+	flagged so far after each chunk, which is committed on its own so the
+	backfill can be restarted with start_note.
+	'''
+	transaction.commit_on_success(add_system_change_flag)()
+
+	cursor = connection.cursor()
+	cursor.execute('SELECT MAX(notesid) FROM notes')
+	max_note = cursor.fetchone()[0] or 0
+
+	total_flagged = 0
+	for first_note in range(start_note, max_note, chunk_size):
+		last_note = min(first_note + chunk_size, max_note)
+		total_flagged += _backfill_system_change_chunk(first_note, last_note)
+		yield last_note, total_flagged
+
+# ==============================================================================
+def _get_column_type(table, column):
+	cursor = connection.cursor()
+	cursor.execute('''
+	SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+	WHERE attrelid=%s::regclass AND attname=%s
+	''', [table, column])
+	return cursor.fetchone()[0]
+
+def add_changelog_dedupe_keys():
+	'''
+	Adds the stored dedupe keys used by the changelog's DISTINCT ONs, the
+	triggers that fill them in when a note or email is saved and their indexes.
+	Safe to run more than once.
+	  * notes.note_hash is md5(note).
+	  * notes.entry_minute is entry_date truncated to the minute.
+	  * emails.add_day is add_date truncated to the day.
+	'''
+	# The notes index is only on the system notes
+	add_system_change_flag()
+
+	cursor = connection.cursor()
+
+	# The buckets have the same type as the dates they come from
+	cursor.execute('ALTER TABLE notes ADD COLUMN IF NOT EXISTS note_hash char(32)')
+	cursor.execute('ALTER TABLE notes ADD COLUMN IF NOT EXISTS entry_minute ' +
+			_get_column_type('notes', 'entry_date'))
+	cursor.execute('ALTER TABLE emails ADD COLUMN IF NOT EXISTS add_day ' +
+			_get_column_type('emails', 'add_date'))
+
+	cursor.execute('''
+	CREATE OR REPLACE FUNCTION changelog_note_dedupe_keys() RETURNS trigger AS $$
+	BEGIN
+		NEW.note_hash := md5(NEW.note);
+		NEW.entry_minute := date_trunc('minute', NEW.entry_date);
+		RETURN NEW;
+	END $$ LANGUAGE plpgsql
+	''')
+	cursor.execute('DROP TRIGGER IF EXISTS notes_changelog_dedupe_keys ON notes')
+	cursor.execute('''
+	CREATE TRIGGER notes_changelog_dedupe_keys
+	BEFORE INSERT OR UPDATE OF note, entry_date ON notes
+	FOR EACH ROW EXECUTE PROCEDURE changelog_note_dedupe_keys()
+	''')
+
+	cursor.execute('''
+	CREATE OR REPLACE FUNCTION changelog_email_dedupe_keys() RETURNS trigger AS $$
+	BEGIN
+		NEW.add_day := date_trunc('day', NEW.add_date);
+		RETURN NEW;
+	END $$ LANGUAGE plpgsql
+	''')
+	cursor.execute('DROP TRIGGER IF EXISTS emails_changelog_dedupe_keys ON emails')
+	cursor.execute('''
+	CREATE TRIGGER emails_changelog_dedupe_keys
+	BEFORE INSERT OR UPDATE OF add_date ON emails
+	FOR EACH ROW EXECUTE PROCEDURE changelog_email_dedupe_keys()
+	''')
+
+	# In the order of the DISTINCT ON and its ORDER BY, so the duplicates can
+	# be skipped while scanning the index instead of sorting first
+	# Replaces the index from before the Issue was part of the keys
+	cursor.execute('DROP INDEX IF EXISTS notes_changelog_dedupe_idx')
+	cursor.execute('''
+	CREATE INDEX IF NOT EXISTS notes_changelog_issue_dedupe_idx
+		ON notes (issue, entry_minute, note_hash, category, notesid)
+		WHERE is_system_change AND is_active
+	''')
+	cursor.execute('''
+	CREATE INDEX IF NOT EXISTS emails_changelog_dedupe_idx
+		ON emails (issue, add_day) WHERE is_active
+	''')
+
+@transaction.commit_on_success
+def _backfill_dedupe_key_chunk(table, first_id, last_id):
+	cursor = connection.cursor()
+	if table == 'notes':
+		cursor.execute('''
+		UPDATE notes SET note_hash=md5(note),
+			entry_minute=date_trunc('minute', entry_date)
+		WHERE notesid > %s AND notesid <= %s
+		''', [first_id, last_id])
+	else:
+		cursor.execute('''
+		UPDATE emails SET add_day=date_trunc('day', add_date)
+		WHERE emailsid > %s AND emailsid <= %s
+		''', [first_id, last_id])
+	return cursor.rowcount
+
+def backfill_changelog_dedupe_keys(chunk_size=10000):
+	'''
+	Adds the dedupe keys (see add_changelog_dedupe_keys) and fills them in for
+	the existing notes and emails. Yields the table, the last ID and the number
+	of rows updated in the table so far after each committed chunk.
+	'''
+	transaction.commit_on_success(add_changelog_dedupe_keys)()
+
+	cursor = connection.cursor()
+	for table, pk in (('notes', 'notesid'), ('emails', 'emailsid')):
+		cursor.execute('SELECT MAX(%s) FROM %s' % (pk, table))
+		max_id = cursor.fetchone()[0] or 0
+
+		total_updated = 0
+		for first_id in range(0, max_id, chunk_size):
+			last_id = min(first_id + chunk_size, max_id)
+			total_updated += _backfill_dedupe_key_chunk(table, first_id, last_id)
+			yield table, last_id, total_updated
+
+# ==============================================================================
+# =============================== SIGNALS ======================================
+# ==============================================================================
+def _flag_system_change_note(sender, instance, **kwargs):
+	# The forms set is_system_change on the notes they write. Until the Note
+	# model has the field it is saved here, once the column has been added.
+	if (getattr(instance, 'is_system_change', False) and instance.pk and
+			_has_system_change_column()):
+		_run_changelog_hook(flag_system_change_notes, [instance.pk])
+
+# Set once notes.is_system_change is found. It isn't looked up again after
+# that, but a process started before add_system_change_flag() keeps checking.
+_system_change_column = []
+
+def _has_system_change_column():
+	if not _system_change_column:
+		cursor = connection.cursor()
+		cursor.execute('''
+		SELECT 1 FROM pg_attribute WHERE attrelid='notes'::regclass
+			AND attname='is_system_change' AND NOT attisdropped
+		''')
+		if cursor.fetchone():
+			_system_change_column.append(True)
+	return bool(_system_change_column)
+
+def _get_first_note_at(issue_id):
+	cursor = connection.cursor()
+	cursor.execute('SELECT first_note_at FROM issue_first_notes WHERE issue=%s',
+			[issue_id])
+	row = cursor.fetchone()
+	return row and row[0]
+
+def _run_changelog_hook(hook, *args):
+	'''
+	Runs a changelog signal handler without letting it break the save that
+	sent the signal. A failure is rolled back to a savepoint, so Postgres'
+	transaction can go on, and logged. The Issue's changelog can be put right
+	with backfill_issue_change_events.
+	'''
+	sid = transaction.savepoint()
+	try:
+		hook(*args)
+	except Exception:
+		transaction.savepoint_rollback(sid)
+		from helpers import logTraceback
+		from zt.ver4 import zutil
+		traceback = 'Error recording the Issue Changelog\n\n%s' % (
+				zutil.get_stack_string())
+		logTraceback(traceback, '%s %s' % (hook.__name__, args))
+	else:
+		transaction.savepoint_commit(sid)
+
+def _is_system_note(note):
+	# The same test as SYSTEM_NOTE_WHERE for a note that may not have the
+	# flag saved yet
+	return (getattr(note, 'is_system_change', False) or
+			'<span' in (note.note or '').lower())
+
+def _record_issue_changes_for_note(sender, instance, **kwargs):
+	issue_id = getFieldItem(instance, ['issue', 'pk'], None)
+	if issue_id:
+		_run_changelog_hook(_record_note_changes, issue_id,
+				_is_system_note(instance))
+
+def _record_note_changes(issue_id, is_system_note):
+	# Other notes are only in the changelog through the Issue's first note
+	# date, which decides which of its emails are shown
+	first_note_at = _get_first_note_at(issue_id)
+	update_issue_first_notes([issue_id])
+	if is_system_note or _get_first_note_at(issue_id) != first_note_at:
+		record_issue_change_events([issue_id])
+
+def _record_issue_changes_for_email(sender, instance, **kwargs):
+	issue_id = getFieldItem(instance, ['issue', 'pk'], None)
+	if issue_id:
+		_run_changelog_hook(record_issue_change_events, [issue_id])
+
+def _record_issue_changes_for_reply(sender, instance, **kwargs):
+	# The reply's person is the "Reported By" value for the email
+	issue_id = getFieldItem(instance, ['email', 'issue', 'pk'], None)
+	if issue_id:
+		_run_changelog_hook(record_issue_change_events, [issue_id])
+
+# The flag has to be saved before the note's changes are recorded
+post_save.connect(_flag_system_change_note, sender=Note)
+post_save.connect(_record_issue_changes_for_note, sender=Note)
+post_save.connect(_record_issue_changes_for_email, sender=Email)
+post_save.connect(_record_issue_changes_for_reply, sender=Reply)
@@ -1,14 +1,31 @@
+import re
 import helpers
 from helpers import render_custom_page, render_data_page, getFieldItem
 from app.models import *
 from app.forms import FilterIssueNoteHistory
+from app.historical_note_models import CHANGELOG_FIELDS, CHANGELOG_COLUMNS, \
+		CHANGELOG_ROW_KEYS, CHANGELOG_ROW_INDEX, ChangelogRow, get_source_change_rows, \
+		get_issue_changelog_versions, IssueChangelogExportJob, update_export_job, \
+		ChangelogQueryLog, execute_changelog_query, start_query_profile, \
+		stop_query_profile, iter_changelog_query, iter_source_change_rows, \
+		SYSTEM_NOTE_WHERE, apply_issue_change, get_issue_state, \
+		EMAIL_PREVIEW_LENGTH, get_email_bodies, load_email_bodies
+from app.historical_note_engine import ChangeHistoryEntity, register_entity, \
+		get_entity, count_ids, get_paged_ids, get_changes, get_history_page, \
+		iter_history_csv
+from app.note_change_parser import get_note_span_text
 from app.templatetags import dicthandlers, permissions
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.conf import settings
 from django.db import transaction, connection
 from django.http import HttpResponseRedirect, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_POST
 from django.db.models import Q
 
+# The number of Issues after which the changelog page is treated as large
+LARGE_QUERY_ISSUES = 200
+
 @login_required
 @user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
 def issue_notes(request):
@@ -33,8 +50,22 @@ def issue_notes(request):
 		num_per_page = -1
 		page = 1
 		
-	issues, total_issues = process_request(request, page, num_per_page)
-	is_large_query = total_issues > 200
+	# next_after_issue is used by the "Next" link so the next page can start
+	# right after this page's last Issue
+	page_info = {}
+	issues, total_issues = process_request(request, page, num_per_page,
+			page_info, getattr(settings, 'ISSUE_CHANGELOG_PAGER_COUNT', 'exact'))
+	next_after_issue = page_info.get('last_issue', None)
+	profile_key = page_info.get('profile_key', None)
+	is_large_query = page_info.get('is_large_query',
+			total_issues > LARGE_QUERY_ISSUES)
+	
+	# With lazy=1 only the labels and change counts are on the page and each
+	# Issue's changes are loaded from issue_changes_json when it is opened
+	lazy = page_info.get('lazy', False)
+	
+	# The HTML of each Issue, mostly from the cache. See render_issue_blocks().
+	issue_blocks = render_issue_blocks(issues, lazy)
 	
 	uis, dummy = helpers.__page_numbers_html(request, total_issues, num_per_page, 
 			page, 1, extra='', form_id='id_changelog_form', use_custom_form=True)
@@ -44,7 +75,142 @@ def issue_notes(request):
 	return render_custom_page(request, template, locals())
 
 # ===============================================================================
-def process_request(request, page, num_per_page):
+# The counters of the rendered Issue block cache's hits and misses
+_BLOCK_HITS_KEY = 'issue_changelog_block_hits'
+_BLOCK_MISSES_KEY = 'issue_changelog_block_misses'
+
+def render_issue_blocks(issues, lazy=False, chunk_size=50):
+	'''
+	Yields the (Issue ID, HTML) of each of the Issues from
+	get_historicalized_notes_and_emails(), rendered with the
+	ISSUE_CHANGELOG_BLOCK_TEMPLATE. The HTML is cached under the Issue's
+	changelog version and ISSUE_CHANGELOG_BLOCK_TEMPLATE_VERSION (bump it when
+	the template changes), so only the Issues that changed get rendered again.
+	The Issues are read chunk_size at a time so the streamed "all" page stays
+	streamed.
+	'''
+	from itertools import islice
+	from django.core.cache import cache
+	from django.template.loader import render_to_string
+	
+	template = getattr(settings, 'ISSUE_CHANGELOG_BLOCK_TEMPLATE',
+			'historical_issue_notes_issue.html')
+	template_version = getattr(settings, 'ISSUE_CHANGELOG_BLOCK_TEMPLATE_VERSION', 1)
+	timeout = getattr(settings, 'ISSUE_CHANGELOG_CACHE_TIMEOUT', 60*60*24)
+	
+	issues = iter(issues)
+	while True:
+		chunk = list(islice(issues, chunk_size))
+		if not chunk:
+			break
+			
+		versions = get_issue_changelog_versions([_[0] for _ in chunk])
+		keys = dict([(i, 'issue_changelog_block_%s_%s_%s_%s' % (i,
+				versions.get(i, 0), template_version, lazy and 1 or 0))
+				for i, issue in chunk])
+		cached = cache.get_many(keys.values())
+		
+		hits = 0
+		for issue_id, issue in chunk:
+			html = cached.get(keys[issue_id])
+			if html is None:
+				html = render_to_string(template, {'issue_id': issue_id,
+						'issue': issue, 'lazy': lazy})
+				cache.set(keys[issue_id], html, timeout)
+			else:
+				hits += 1
+			yield issue_id, html
+			
+		_count_block_cache(hits, len(chunk) - hits)
+
+def _count_block_cache(hits, misses):
+	from django.core.cache import cache
+	try:
+		cache.incr(_BLOCK_HITS_KEY, hits)
+		cache.incr(_BLOCK_MISSES_KEY, misses)
+	except ValueError:
+		# A counter isn't in the cache yet or was dropped. Both start over
+		# together so they always cover the same stretch of time. The timeout
+		# is the longest memcached takes as a number of seconds.
+		cache.set_many({_BLOCK_HITS_KEY: hits, _BLOCK_MISSES_KEY: misses},
+				getattr(settings, 'ISSUE_CHANGELOG_BLOCK_STATS_TIMEOUT',
+				60*60*24*30))
+
+def get_block_cache_stats():
+	'''
+	Returns the hits, misses and hit rate of the rendered Issue block cache
+	since the counters were last reset. They are kept for
+	ISSUE_CHANGELOG_BLOCK_STATS_TIMEOUT seconds (30 days) and start over when
+	the cache drops either of them.
+	'''
+	from django.core.cache import cache
+	counts = cache.get_many([_BLOCK_HITS_KEY, _BLOCK_MISSES_KEY])
+	hits = counts.get(_BLOCK_HITS_KEY, 0)
+	misses = counts.get(_BLOCK_MISSES_KEY, 0)
+	return {'hits': hits, 'misses': misses,
+			'hit_rate': hits + misses and float(hits) / (hits + misses) or 0.0}
+
+def reset_block_cache_stats():
+	from django.core.cache import cache
+	cache.delete_many([_BLOCK_HITS_KEY, _BLOCK_MISSES_KEY])
+
+# ===============================================================================
+def process_request(request, page, num_per_page, page_info=None,
+		count='exact'):
+	
+	post = request.GET
+	wheres, ewheres, wheres_args, ewheres_args = get_filter_wheres(post)
+		
+	after_issue = post.get('after_issue', '')
+	if not after_issue.isdigit():
+		after_issue = None
+		
+	# Admins can add profile_sql=1 (or profile_sql=explain for the query
+	# plans) to the URL to log the page's queries
+	profile_key = None
+	if post.get('profile_sql'):
+		import uuid
+		profile_key = uuid.uuid4().hex
+		if page_info is not None:
+			page_info['profile_key'] = profile_key
+		
+	total_issues = 0
+	issues = []
+	if post.get('page'):
+		# Only show issues after a search has been done. This will help
+		# with the page's initial load time.
+		issues, total_issues = get_historicalized_notes_and_emails(wheres, ewheres,
+				wheres_args, ewheres_args, page, num_per_page, after_issue,
+				page_info, profile_key, post.get('profile_sql') == 'explain',
+				getattr(request, 'user', None), count,
+				lazy=post.get('lazy') == '1')
+				
+	return issues, total_issues
+
+# ===============================================================================
+def _use_change_events():
+	# The changelog is read from the issue_change_events table once
+	# backfill_issue_change_events has filled it and ISSUE_CHANGELOG_USE_EVENTS
+	# is turned on. Until then it would come back empty, so the notes and
+	# emails are parsed instead.
+	return getattr(settings, 'ISSUE_CHANGELOG_USE_EVENTS', False)
+
+# ===============================================================================
+# Matches the notes that changed a field to the given value. The value is
+# matched on its ID and on its text when the change couldn't be tied to an ID.
+# Takes the field name, value ID and ILIKE pattern as its parameters.
+_CHANGE_EVENT_WHERE = '''n.notesid IN (
+		SELECT ev.note FROM issue_change_events ev
+		WHERE ev.note IS NOT NULL AND ev.field=%s AND (ev.new_value_id=%s OR (
+			ev.new_value_id IS NULL AND ev.new_value ILIKE %s)))'''
+
+def get_filter_wheres(post, use_events=None):
+	'''
+	Turns the FilterIssueNoteHistory form's GET data into the notes and emails
+	queries used by get_historicalized_notes_and_emails(). use_events defaults
+	to the ISSUE_CHANGELOG_USE_EVENTS setting. See compare_changelog_filters()
+	in historical_note_benchmarks for how the two ways of filtering differ.
+	'''
 	
 	# Process the form query
 	wheres = []
@@ -52,7 +218,6 @@ def process_request(request, page, num_per_page):
 	wheres_args = []
 	ewheres_args = []
 			
-	post = request.GET
 	if post.get('issue_id'):
 		ids = post['issue_id'].split()
 		id_n_sql = []
@@ -85,235 +250,650 @@ def process_request(request, page, num_per_page):
 		ewheres.append('e.add_date < %s')
 		ewheres_args.append(cde.strftime('%Y-%m-%d 00:00'))
 		
+	# The type, disposition and project filters are matched against the
+	# indexed issue_change_events table. Without it the notes' text has to be
+	# searched.
+	if use_events is None:
+		use_events = _use_change_events()
+	
 	if post.get('issue_type'):
 		it = get_object_or_404(IssueType, pk=post['issue_type'])
-		wheres.append('n.note ILIKE %s')
-		wheres_args.append('%%type%%to %%%s%%' % it.type)
+		if use_events:
+			wheres.append(_CHANGE_EVENT_WHERE)
+			wheres_args += ['issue_type', it.pk, '%%%s%%' % it.type]
+		else:
+			wheres.append('n.note ILIKE %s')
+			wheres_args.append('%%type%%to %%%s%%' % it.type)
 		
 	if post.get('issue_disposition'):
 		id = get_object_or_404(IssueDisposition, pk=post['issue_disposition'])
-		wheres.append('n.note ILIKE %s')
-		wheres_args.append('%%disposition%%to %%%s%%' % id.disposition)
+		if use_events:
+			wheres.append(_CHANGE_EVENT_WHERE)
+			wheres_args += ['issue_disposition', id.pk, '%%%s%%' % id.disposition]
+		else:
+			wheres.append('n.note ILIKE %s')
+			wheres_args.append('%%disposition%%to %%%s%%' % id.disposition)
 		
 	if post.get('project'):
 		p = get_object_or_404(IssueProject, pk=post['project'])
-		wheres.append('n.note ILIKE %s')
-		wheres_args.append('%%project%%to %%%s%%' % p.name)
+		if use_events:
+			wheres.append(_CHANGE_EVENT_WHERE)
+			wheres_args += ['project', p.pk, '%%%s%%' % p.name]
+		else:
+			wheres.append('n.note ILIKE %s')
+			wheres_args.append('%%project%%to %%%s%%' % p.name)
 				
 	rtr = post.get('related_to_relation')
 	if rtr and rtr.isdigit():		
 		rt = get_object_or_404(Person, pk=rtr)
-		wheres.append('n.note ILIKE %s')
 		ewheres.append('(r.reply_type=1 AND ea.person=%s)')
 		rt_name = '%s %s' % (rt.first_name, rt.last_name)
+		# The reported_by events also hold the note's person, which every note
+		# falls back to, so only the text says which notes changed Reported By
+		wheres.append('n.note ILIKE %s')
 		wheres_args.append('%%reported by%%to %%%s%%' % rt_name)
 		ewheres_args.append(int(rtr))
 		
-	total_issues = 0
-	issues = []
-	if post.get('page'):
-		# Only show issues after a search has been done. This will help
-		# with the page's initial load time.
-		issues, total_issues = get_historicalized_notes_and_emails(wheres, ewheres,
-				wheres_args, ewheres_args, page, num_per_page)
-				
-	return issues, total_issues
+	return wheres, ewheres, wheres_args, ewheres_args
 
 # ===============================================================================
 def get_historicalized_notes_and_emails(wheres=[], ewheres=[], wheres_params=[],
-		ewheres_params=[], page=1, total_per_page=50):
+		ewheres_params=[], page=1, total_per_page=50, after_issue=None,
+		page_info=None, profile_key=None, explain=False, user=None,
+		count='exact', use_cache=True, lazy=False):
 	'''	
 	  * wheres is a list of queries that will be matched up against the notes.
 	  * ewheres is a list of queries that will be matched up against the emails.
+	  * after_issue is the last Issue ID of the previous page. When it is given,
+	    the page starts right after that Issue instead of skipping over the
+	    earlier pages so every page costs the same as the first one.
+	  * page_info is an optional dictionary that gets the 'last_issue' of the
+	    page set in it. Pass it back in as after_issue to get the next page.
+	  * profile_key turns on the query profiling. Every query is logged to the
+	    issue_changelog_query_logs table under the key, with its EXPLAIN
+	    ANALYZE output when explain is True. See changelog_query_profile.
+	  * count is how the total is found. See count_ids() in
+	    historical_note_engine. page_info also gets 'is_large_query' set in
+	    it, from a capped count when the total is only an estimate.
+	  * use_cache looks the search up in the result cache first. See
+	    _find_issue_ids().
+	  * lazy leaves out the changes of the Issues on the page. Each Issue gets
+	    its label and 'change_count' instead. See get_issue_change_counts().
 	
 	Returns a sorted dictionary of lists. The first value in the inner list is the Issue ID
 	and the second value is a list of either Notes or Emails for the Issue.	
+	When every Issue is asked for (a negative total_per_page) it is a generator
+	instead. See iter_issue_changes().
 	'''
+	if profile_key:
+		start_query_profile(profile_key, explain, user)
+		try:
+			issues, total = get_historicalized_notes_and_emails(wheres,
+					ewheres, wheres_params, ewheres_params, page,
+					total_per_page, after_issue, page_info, count=count,
+					use_cache=False, lazy=lazy)
+		finally:
+			stop_query_profile()
+		if total_per_page < 0:
+			# The generator's queries run as it is read, after this returns
+			issues = _iter_profiled(issues, profile_key, explain, user)
+		return issues, total
 		
-	issues = {}
+	result = _find_issue_ids(wheres, ewheres, wheres_params + ewheres_params,
+			page, total_per_page, after_issue, count, use_cache)
+	issueids = result['issueids']
 	
-	wheres = ' AND '.join(wheres).strip()
-	if wheres:
-		wheres = 'AND ' + wheres
+	if page_info is not None:
+		page_info['is_large_query'] = result['is_large_query']
+		page_info['last_issue'] = issueids and issueids[-1] or None
+		
+	if total_per_page < 0:
+		# Every Issue is streamed instead of being built all at once
+		return iter_issue_changes(issueids), result['total_issues']
+		
+	if lazy:
+		if page_info is not None:
+			page_info['lazy'] = True
+		return get_issue_change_counts(issueids), result['total_issues']
+			
+	issues = get_issue_changes(issueids)
+		
+	return issues, result['total_issues']
+
+def _iter_profiled(issues, profile_key, explain, user):
+	# Runs the query profile again while the "all" page's generator is read
+	start_query_profile(profile_key, explain, user)
+	try:
+		for issue in issues:
+			yield issue
+	finally:
+		stop_query_profile()
+
+# ==============================================================================
+def _get_result_cache():
+	'''
+	Returns the cache that the search results are kept in. It has to be shared
+	by all of the web server's processes, so it is the ISSUE_CHANGELOG_RESULT_CACHE
+	cache from the CACHES setting, or a file based cache in the temp directory.
+	'''
+	from django.core.cache import get_cache
 	
-	ewheres = ' AND '.join(ewheres).strip()
-	if ewheres:
-		ewheres = 'AND ' + ewheres
+	alias = getattr(settings, 'ISSUE_CHANGELOG_RESULT_CACHE', None)
+	if alias:
+		return get_cache(alias)
+		
+	import os
+	import tempfile
+	return get_cache('django.core.cache.backends.filebased.FileBasedCache',
+			LOCATION=os.path.join(tempfile.gettempdir(), 'issue_changelog_results'))
+
+def _find_issue_ids(wheres, ewheres, params, page=1, total_per_page=50,
+		after_issue=None, count='exact', use_cache=True):
+	'''
+	Finds the Issue IDs for the page and the total number of Issues.
+	
+	The results are cached by the filters and the page for
+	ISSUE_CHANGELOG_RESULT_CACHE_TIMEOUT seconds. The changelog versions of the
+	page's Issues are saved with them, so a note or email on one of the Issues
+	throws the cached result out. Issues that start matching the filters
+	because of a new note only show up once the result times out.
+	'''
+	import hashlib
+	
+	key = 'issue_changelog_result_%s' % hashlib.md5(repr((wheres, ewheres,
+			params, page, total_per_page, after_issue, count))).hexdigest()
+	
+	if use_cache:
+		result_cache = _get_result_cache()
+		result = result_cache.get(key)
+		if result and get_issue_changelog_versions(
+				result['issueids']) == result['versions']:
+			return result
+			
+	ids_sql = _get_issue_ids_sql(wheres, ewheres)
+	
+	# Get the total number of issues found.
+	total_issues = count_ids(ids_sql, params, count, LARGE_QUERY_ISSUES, 'issue')
+	if count == 'estimate':
+		is_large_query = count_ids(ids_sql, params, 'capped',
+				LARGE_QUERY_ISSUES, 'issue') > LARGE_QUERY_ISSUES
+	else:
+		is_large_query = total_issues > LARGE_QUERY_ISSUES
+	
+	# Get the paged issue numbers. The limit and offset are figured out in the
+	# database so only the Issues on the page are ever fetched.
+	issueids = get_paged_ids(ids_sql, params, page, total_per_page,
+			after_issue, 'issue')
+	
+	result = {'issueids': issueids, 'total_issues': total_issues,
+			'is_large_query': is_large_query,
+			'versions': get_issue_changelog_versions(issueids)}
+	
+	if use_cache:
+		result_cache.set(key, result, getattr(settings,
+				'ISSUE_CHANGELOG_RESULT_CACHE_TIMEOUT', 60*10))
 				
-	# Get the paged issue numbers
-	sql = '''
-	SELECT COALESCE(n.issue, e.issue) FROM notes n
-	FULL JOIN emails e ON (e.issue=n.issue)
-	LEFT JOIN replies r ON (r.email=e.emailsid AND r.reply_type=1)
-	LEFT JOIN email_addresses ea ON (ea.email_addressesid=r.email_address)
-	WHERE (n.is_active AND n.issue IS NOT NULL AND n.note ILIKE '%%%%<span%%%%' %s) OR (
-		e.is_active AND e.issue IS NOT NULL AND e.add_date < (SELECT entry_date FROM notes WHERE issue=e.issue ORDER BY entry_date LIMIT 1) AND e.was_received %s)
-	GROUP BY COALESCE(n.issue, e.issue)
-	ORDER BY COALESCE(n.issue, e.issue)
-	''' % (wheres, ewheres)
+	return result
+
+# ==============================================================================
+class IssueHistory(ChangeHistoryEntity):
+	'''
+	The Issue Changelog as a change history entity. Its wheres are the
+	(wheres, ewheres) pair from get_filter_wheres().
+	'''
+	name = 'issue'
+	id_column = 'issue'
+	csv_header = ['Issue ID', 'Date', 'Title', 'Issue Disposition', 'Issue Type',
+			'Issue Project', 'Reported By', 'Tickets']
+	csv_fields = ['entry_date', 'title', 'issue_disposition', 'issue_type',
+			'project', 'reported_by', 'tickets']
+	
+	def get_filter_wheres(self, get):
+		wheres, ewheres, wheres_args, ewheres_args = get_filter_wheres(get)
+		return (wheres, ewheres), wheres_args + ewheres_args
+		
+	def get_ids_sql(self, wheres):
+		return _get_issue_ids_sql(*wheres)
+		
+	def get_versions(self, ids):
+		return get_issue_changelog_versions(ids)
 		
-	cursor = connection.cursor()	
+	def build_changes(self, ids):
+		return _build_issue_changes_in_chunks(ids)
+		
+	def get_csv_rows(self, issue_id, issue):
+		rows = []
+		for change in issue.get('changes', []):
+			# Use the changed value and fall back to the history value like
+			# the Excel export does
+			row = [issue_id]
+			for f in self.csv_fields:
+				row.append(change.get(f, '') or change.get('changed_%s' % f,
+						'') or change.get('history_%s' % f, ''))
+			rows.append(row)
+		return rows
+
+ISSUE_HISTORY = register_entity(IssueHistory())
 
-	cursor.execute(sql, wheres_params+ewheres_params)
+# ==============================================================================
+def get_issue_changes(issueids):
+	'''
+	Returns the changelog for the given Issues in the same format as
+	get_historicalized_notes_and_emails().
+	
+	Each Issue's changelog is cached under its changelog version, which goes up
+	whenever a note or email is added to the Issue, so only the Issues that have
+	changed since they were last viewed get rebuilt.
+	'''
+	return get_changes(ISSUE_HISTORY, issueids)
 
-	# Adding the -1 in there to make sure that the list isn't empty which
-	# can lead to all sorts of problems in the SQL
-	issueids = [str(_[0]) for _ in cursor.fetchall()] + ['-1']
+# ==============================================================================
+def get_issue_change_counts(issueids):
+	'''
+	Returns the labels and the number of changes of the given Issues, in the
+	same format as get_issue_changes() but with an empty list of changes and
+	a 'change_count'. It is counted from the issue_change_events table without
+	building the changelogs.
+	'''
+	if not _use_change_events():
+		# The changes can only be counted by building them
+		issues = get_issue_changes(issueids)
+		return [(i, {'label': issue['label'], 'changes': [],
+				'change_count': len(issue['changes'])}) for i, issue in issues]
+	
+	if not issueids:
+		return []
 		
-	# Get the total number of issues found. Take off one for the -1 appended to
-	# the list
-	total_issues = len(issueids) - 1
+	# The events hold every value a note or email had, changed or not, so a
+	# value only counts when it differs from the field's value before it, the
+	# same as _assemble_issue_changes() decides. "None" values are removals,
+	# which the changelog doesn't show as a change on their own.
+	cursor = execute_changelog_query('issue change counts', '''
+	SELECT i.issuesid, i.title,
+		COUNT(DISTINCT ch.note) + COUNT(DISTINCT ch.email)
+	FROM (
+		SELECT v.issue, v.note, v.email, v.value,
+			lag(v.value) OVER (PARTITION BY v.issue, v.field ORDER BY
+				v.change_date, COALESCE(v.note, v.email), v.email IS NOT NULL,
+				v.issue_change_eventsid) AS prev_value
+		FROM (
+			SELECT ev.*, CASE WHEN lower(ev.new_value) = 'none' THEN ''
+				ELSE trim(ev.new_value) END AS value
+			FROM issue_change_events ev
+			WHERE ev.issue = ANY(%s)
+		) v
+	) ch
+	JOIN issues i ON (ch.issue=i.issuesid)
+	WHERE ch.value <> '' AND ch.value IS DISTINCT FROM ch.prev_value
+	GROUP BY i.issuesid, i.title
+	ORDER BY i.issuesid
+	''', [[int(_) for _ in issueids]])
+	
+	return [(issue_id, {'label': '%s - %s' % (issue_id, title), 'changes': [],
+			'change_count': change_count})
+			for issue_id, title, change_count in cursor.fetchall()]
+
+# ==============================================================================
+def iter_issue_changes(issueids, batch_size=1000):
+	'''
+	Yields the (Issue ID, changelog) pairs of the given Issues in order, one
+	Issue at a time as its rows come in from a server-side cursor. This is for
+	the "all" page and the exports, where holding every row (and every email
+	body) at once takes too much memory. The per-Issue cache isn't used since
+	the whole point is to not keep everything around.
+	
+	With ISSUE_CHANGELOG_WORKERS set and more Issues than fit in one
+	ISSUE_CHANGELOG_WORKER_CHUNK, the chunks are built by a pool of worker
+	processes instead and yielded in order as they finish.
+	
+	The generator has to be used up inside the request's transaction.
+	'''
+	from itertools import groupby
+	from operator import itemgetter
+	
+	workers, chunk_size = _get_worker_settings()
+	if workers >= 2 and len(issueids) > chunk_size:
+		for issue in _iter_pooled_issue_changes(issueids, workers, chunk_size):
+			yield issue
+		return
 		
-	# Get the limit and offset values to determine which section of the Issues
-	# to use in the query based on which page the user is on.
-	if page < 0:
-		limit = 0
-		offset = total_per_page
+	if _use_change_events():
+		cols, rows = _get_change_event_rows(issueids, batch_size)
 	else:
-		if page < 1: page = 1
-		limit = (page-1)*total_per_page
-		offset = page*total_per_page
-			
-	issueids = issueids[limit:offset]
-	issueids = ','.join(issueids).strip()
-			
-	# Query the database. Order by the issue, note date and note id in that
-	# order
-	
-	sql = """
-	(
-	SELECT DISTINCT ON (date_trunc('minute', n.entry_date), md5(n.note)) 'note' as type, n.notesid as id, n.entry_date, n.category, n.issue AS "issue_id",
-					COALESCE(trim(replace(substring(n.note, '.*[Tt]itle.*?to (?:&quot;|"|'')(.+?)(?:&quot;|"|'').*'), E'\n', ' ')), '') AS "changed_title", i.title AS "current_title",
-					COALESCE(trim(replace(substring(n.note, '.*[Ii]ssue [Pp]roject.*?to (?:&quot;|"|'')(.+?)(?:&quot;|"|'').*'), E'\n', ' ')), '') AS "changed_project", ip.name AS "current_project",
-					COALESCE(trim(replace(substring(n.note, '.*[Ii]ssue [Tt]ype.*?to (?:&quot;|"|'')(.+?)(?:&quot;|"|'').*'), E'\n', ' ')), '') AS "changed_issue_type", it.type AS "current_issue_type",
-					COALESCE(trim(replace(substring(n.note, '(?:.*disposition of ''(.+?)''.*)|(?:.*[Ii]ssue [Dd]isposition.*?to (?:&quot;|"|'')(.+?)(?:&quot;|"|'').*)'), E'\n', ' ')), '') AS "changed_issue_disposition", id.disposition AS "current_issue_disposition",
-					COALESCE(trim(replace(substring(n.note, '.*[Rr]eported [Bb]y.*?to (?:&quot;|"|'')(.+?)(?:&quot;|"|'').*'), E'\n', ' ')), CASE WHEN p.peopleid IS NOT NULL THEN (COALESCE(p.last_name, '') || ', ' || COALESCE(p.first_name, '')) ELSE '' END) AS "changed_reported_by", CASE WHEN p2.peopleid IS NOT NULL THEN (COALESCE(p2.last_name, '') || ', ' || COALESCE(p2.first_name, '')) ELSE '' END AS "current_reported_by",
-					COALESCE(trim(replace(substring(n.note, '.*[Tt]ickets.*?to (?:&quot;|"|'')(.+?)(?:&quot;|"|'').*'), E'\n', ' ')), '') AS "changed_tickets", COALESCE(i.tickets, '') AS "current_tickets",
-					nt.type AS "note_type",
-					n.entry_date AS "change_date",
-					trim(replace(replace(substring(n.note from '<span.*?>(.+)</span>'), E'\n', ' '), '&quot;', '"')) AS "raw_note"
-	FROM notes n
-	JOIN issues i ON (n.issue=i.issuesid)
-	LEFT JOIN issue_dispositions id ON (id.issue_dispositionsid=i.issue_disposition)
-	LEFT JOIN people p ON (p.peopleid=n.issue_person)
-	LEFT JOIN people p2 ON (p2.peopleid=i.person)
-	LEFT JOIN note_types nt ON (nt.note_typesid=n.type)
-	LEFT JOIN note_categories nc ON (nc.note_categoriesid=n.category)
-	LEFT JOIN auth_user au ON (au.id=n.created_by)
-	LEFT JOIN issue_projects ip ON (ip.issue_projectsid=i.issue_projectsid)
-	LEFT JOIN issue_types it ON (it.issue_typesid=i.issue_type)
-	WHERE n.is_active AND n.issue IN (%s
-		) AND n.note ILIKE '%%%%<span%%%%'
-	ORDER BY date_trunc('minute', n.entry_date), md5(n.note), n.category, n.notesid
-	)
-	UNION ALL
-	(
-	SELECT DISTINCT ON(data.issue,date_trunc('day',data.add_date)) 'email' as type, data.emailsid as id, data.add_date, null as category, data.issue AS "issue_id",
-                COALESCE(trim(replace(substring(data.subject, E'\[zt [0-9]+\] (.+)'), E'', ' ')), ' ') AS "changed_title", 
-                data.title AS "current_title",
-                'ledsSuite' AS "changed_project", 
-                data.name AS "current_project",
-                'Incident' AS "changed_issue_type", 
-                data.type AS "current_issue_type",
-                'In Support' AS "changed_issue_disposition", 
-                data.disposition AS "current_issue_disposition",
-                CASE WHEN data.people_id_1 IS NOT NULL THEN (COALESCE(data.last_name_1, '') || ', ' || COALESCE(data.first_name_1, ''))  ELSE '' END AS "changed_reported_by", 
-                CASE WHEN data.people_id_2 IS NOT NULL THEN (COALESCE(data.last_name_2, '') || ', ' || COALESCE(data.first_name_2, '')) ELSE '' END AS "current_reported_by",
-                '' AS "changed_tickets", 
-                COALESCE(data.tickets, '') AS "current_tickets",
-                'Email' AS "note_type",
-                data.add_date AS "change_date",
-                data.body AS "raw_note"                              
-                
-				FROM 
-				(SELECT 
-				   e.emailsid,e.add_date,e.subject,e.body,e.issue,i.title,i.tickets,
-				   p.last_name as last_name_1,p.peopleid as people_id_1,p.first_name as first_name_1,
-				   p2.peopleid as people_id_2,p2.last_name as last_name_2,
-				   p2.first_name as first_name_2,id.disposition,it.type,ip.name                  
-				FROM emails e
-				JOIN issues i ON (e.issue=i.issuesid)
-				JOIN replies r ON (r.email = e.emailsid)
-				LEFT JOIN email_addresses ea ON (ea.email_addressesid=r.email_address)
-				LEFT JOIN people p ON (ea.person=p.peopleid)
-				LEFT JOIN people p2 ON (p2.peopleid=i.person)
-				LEFT JOIN issue_dispositions id ON (id.issue_dispositionsid=i.issue_disposition)
-				LEFT JOIN issue_projects ip ON (ip.issue_projectsid=i.issue_projectsid)
-				LEFT JOIN issue_types it ON (it.issue_typesid=i.issue_type)
-				WHERE e.is_active 
-				AND e.issue IN (%s)
-				AND e.add_date < (SELECT entry_date FROM notes WHERE issue=e.issue
-				ORDER BY entry_date LIMIT 1) 
-				  ) AS data 
-				  ORDER BY data.issue,date_trunc('day',data.add_date)
-				  ) 
-				ORDER BY 5, 3, 2, 4
-
-			""" % (
-					issueids,
-					issueids,
-					)	
-								
-	cursor = connection.cursor()
-	cursor.execute(sql, [])
-
-	cols = [column[0] for column in cursor.description]
-	rows = cursor.fetchall()
-	
-	def _check_row(r):
-		fields = ['changed_project', 'changed_issue_type', 'changed_issue_disposition',
-				'changed_reported_by', 'changed_tickets', 'changed_title']
-		for f in fields:
-			if r[f] and r[f].strip():
-				return True		
-		return False
-	
-	def _fill_history_fields(row, prev_row):
-		fields = ['project', 'issue_type', 'issue_disposition',
-				'reported_by', 'tickets', 'title']
+		rows = iter_source_change_rows(issueids, batch_size)
+		
+	for issue_id, issue_rows in groupby(rows, itemgetter(_ISSUE_INDEX)):
+		issue = _assemble_issue_changes(issue_rows).get(issue_id)
+		if issue:
+			yield issue_id, issue
+
+# ==============================================================================
+def _build_issue_changes_in_chunks(issueids, workers=None, chunk_size=None):
+	'''
+	Builds the changelogs the same way _build_issue_changes() does. When there
+	are more Issues than fit in one chunk (like on the "all" page) the Issues
+	are split into chunks that a pool of worker processes builds at the same
+	time. The number of workers defaults to ISSUE_CHANGELOG_WORKERS and a
+	value under 2 keeps everything in this process.
+	'''
+	default_workers, default_chunk_size = _get_worker_settings()
+	if workers is None:
+		workers = default_workers
+	if chunk_size is None:
+		chunk_size = default_chunk_size
+		
+	if workers < 2 or len(issueids) <= chunk_size:
+		return _build_issue_changes(issueids)
+		
+	pool = _make_worker_pool(workers)
+	try:
+		# map() hands the results back in the same order as the chunks
+		results = pool.map(_build_issue_changes, _split_chunks(issueids,
+				chunk_size))
+	finally:
+		pool.close()
+		pool.join()
+		
+	issues = {}
+	for result in results:
+		issues.update(result)
+	return issues
+
+def _iter_pooled_issue_changes(issueids, workers, chunk_size):
+	# Yields the (Issue ID, changelog) pairs of each chunk built by the worker
+	# pool, in order, as soon as the chunk is done
+	pool = _make_worker_pool(workers)
+	try:
+		# imap() hands the results back in the same order as the chunks
+		for issues in pool.imap(_build_issue_changes, _split_chunks(issueids,
+				chunk_size)):
+			for issue_id in sorted(issues):
+				yield issue_id, issues[issue_id]
+	finally:
+		# Stops the workers too when the generator isn't used up
+		pool.terminate()
+		pool.join()
+
+def _get_worker_settings():
+	# The number of worker processes and the Issues in each of their chunks
+	return (getattr(settings, 'ISSUE_CHANGELOG_WORKERS', 0),
+			getattr(settings, 'ISSUE_CHANGELOG_WORKER_CHUNK', 500))
+
+def _split_chunks(issueids, chunk_size):
+	return [issueids[i:i+chunk_size] for i in range(0, len(issueids),
+			chunk_size)]
+
+def _make_worker_pool(workers):
+	from multiprocessing import Pool
+	
+	# The workers are forked from this process and would share its database
+	# connection's socket. Close it first so every worker opens its own, and
+	# this process opens a new one the next time it queries. Anything this
+	# transaction hasn't committed is lost, so this is only for reads.
+	connection.close()
+	return Pool(workers)
+
+# ==============================================================================
+def _build_issue_changes(issueids):
+	# Builds the changelog dictionary for the given Issues from the database
+	# Query the changes. Ordered by the issue, note date and note id in that
+	# order. The issue_change_events table holds the already parsed notes so
+	# only fall back to parsing them when it isn't being used.
+	if _use_change_events():
+		cols, rows = _get_change_event_rows(issueids)
+	else:
+		cols, rows = get_source_change_rows(issueids, getattr(settings,
+				'ISSUE_CHANGELOG_CONCURRENT_HALVES', False))
+	
+	return _assemble_issue_changes(rows)
+
+# ==============================================================================
+# The field and the (changed, history) positions of each changelog field in a
+# row's values
+_HISTORY_INDEXES = [(_, CHANGELOG_ROW_INDEX['changed_%s' % _],
+		CHANGELOG_ROW_INDEX['history_%s' % _]) for _ in CHANGELOG_FIELDS]
+_CHANGED_INDEXES = [_[1] for _ in _HISTORY_INDEXES]
+_ISSUE_INDEX = CHANGELOG_ROW_INDEX['issue_id']
+_TITLE_INDEX = CHANGELOG_ROW_INDEX['current_title']
+_BLANK_HISTORY = [''] * len(CHANGELOG_FIELDS)
+_BLANK_ROW = [''] * len(CHANGELOG_ROW_KEYS)
+
+def _assemble_issue_changes(rows):
+	'''
+	Turns the changelog rows (in CHANGELOG_COLUMNS order, sorted by issue and
+	date) into the changelog dictionary, filling in the history_* values and
+	dropping the rows that didn't change anything.
+	
+	The history (grayed out) values are the Issue's state after the row, the
+	same as get_issue_state() gives for the row's date.
+	'''
+	issues = {}
+	prev_values = _BLANK_ROW
+	state = {}
+	for values in rows:
+		values = list(values)
+		values.extend(_BLANK_HISTORY)
+		
+		# Each Issue's history starts over
+		if values[_ISSUE_INDEX] != prev_values[_ISSUE_INDEX]:
+			prev_values = _BLANK_ROW
+			state = {}
 			
-		for f in fields:
-			ckey = 'changed_%s' % f
-			hkey = 'history_%s' % f
-			crow = row.get(ckey, '')
+		for field, ckey, hkey in _HISTORY_INDEXES:
+			crow = values[ckey]
 			
 			# Change "None" values to blank spaces so they display as removed
 			# on the History page.
 			if crow is None or crow.lower() == 'none':
-				row[ckey] = ' '
+				values[ckey] = ' '
 				
 			# Remove the change value if it hasn't actually changed
-			if crow in [prev_row.get(ckey, ''), prev_row.get(hkey, '')]:
-				row[ckey] = ''
-								
-			# Set the history (grayed out) value to current changed value. 
-			# If there was no current change then use the previous changed value.
-			# If the previous changed value doesn't exist, then use the previous
-			# history value.
-			row[hkey] = crow or prev_row.get(ckey, None) or prev_row.get(hkey, ' ')
-			row[hkey] = row[hkey].strip()
-		return row
+			if crow == prev_values[ckey] or crow == prev_values[hkey]:
+				values[ckey] = ''
+				
+			apply_issue_change(state, field, crow)
+			values[hkey] = state.get(field, '')
+			
+		# Only keep the rows that still have a change in them
+		for ckey in _CHANGED_INDEXES:
+			changed = values[ckey]
+			if changed and changed.strip():
+				issue_id = values[_ISSUE_INDEX]
+				if issue_id not in issues:
+					issues[issue_id] = {'label': '%s - %s' % (issue_id,
+							values[_TITLE_INDEX]), 'changes': []}
+				issues[issue_id]['changes'].append(ChangelogRow(values))
+				break
 		
-	prev_row = {}
-	for row in rows:
-		row = dict(zip(cols, row))
+		prev_values = values
 		
-		if row['issue_id'] != prev_row.get('issue_id'):
-			prev_row = {}
+	return issues
+
+# ==============================================================================
+def _get_issue_ids_sql(wheres, ewheres):
+	'''
+	Returns the query for the IDs of the Issues that have a change matching the
+	wheres (notes) or ewheres (emails). It is meant to be used as a subquery.
+	'''
+	wheres = ' AND '.join(wheres).strip()
+	if wheres:
+		wheres = 'AND ' + wheres
+	
+	ewheres = ' AND '.join(ewheres).strip()
+	if ewheres:
+		ewheres = 'AND ' + ewheres
+				
+	return '''
+	SELECT COALESCE(n.issue, e.issue) AS issue FROM notes n
+	FULL JOIN emails e ON (e.issue=n.issue)
+	LEFT JOIN issue_first_notes fn ON (fn.issue=e.issue)
+	LEFT JOIN replies r ON (r.email=e.emailsid AND r.reply_type=1)
+	LEFT JOIN email_addresses ea ON (ea.email_addressesid=r.email_address)
+	WHERE (n.is_active AND n.issue IS NOT NULL AND %s %s) OR (
+		e.is_active AND e.issue IS NOT NULL AND e.add_date < fn.first_note_at AND e.was_received %s)
+	GROUP BY COALESCE(n.issue, e.issue)
+	''' % (SYSTEM_NOTE_WHERE, wheres, ewheres)
+
+# ==============================================================================
+# The events of the Issues in the parameter, ordered so that each note's or
+# email's events are together. See _get_change_event_rows().
+_CHANGE_EVENT_ROWS_SQL = """
+	SELECT ev.issue, ev.note, ev.email, ev.change_date, ev.field, ev.new_value,
+		n.category, COALESCE(nt.type, 'Email'),
+		COALESCE(n.note, left(e.body, """ + str(EMAIL_PREVIEW_LENGTH) + """)),
+		i.title, ip.name, it.type, id.disposition,
+		CASE WHEN p2.peopleid IS NOT NULL THEN (COALESCE(p2.last_name, '') || ', ' || COALESCE(p2.first_name, '')) ELSE '' END,
+		COALESCE(i.tickets, '')
+	FROM issue_change_events ev
+	JOIN issues i ON (ev.issue=i.issuesid)
+	LEFT JOIN notes n ON (n.notesid=ev.note)
+	LEFT JOIN note_types nt ON (nt.note_typesid=n.type)
+	LEFT JOIN emails e ON (e.emailsid=ev.email)
+	LEFT JOIN people p2 ON (p2.peopleid=i.person)
+	LEFT JOIN issue_dispositions id ON (id.issue_dispositionsid=i.issue_disposition)
+	LEFT JOIN issue_projects ip ON (ip.issue_projectsid=i.issue_projectsid)
+	LEFT JOIN issue_types it ON (it.issue_typesid=i.issue_type)
+	WHERE ev.issue = ANY(%s)
+	ORDER BY ev.issue, ev.change_date, COALESCE(ev.note, ev.email), ev.email IS NOT NULL,
+		ev.issue_change_eventsid
+	"""
+
+def _get_change_event_rows(issueids, batch_size=None):
+	'''
+	Reads the changes for the given Issues from the issue_change_events table.
+	Returns the same columns and row order as get_source_change_rows(), with
+	the events of each note or email put back together into one row.
+	
+	With a batch_size the rows are read from a server-side cursor and returned
+	as a generator instead of a list.
+	'''
+	params = [[int(_) for _ in issueids]]
+	if batch_size:
+		events = iter_changelog_query('change event rows', _CHANGE_EVENT_ROWS_SQL,
+				params, batch_size)
+		return CHANGELOG_COLUMNS, _pivot_change_events(events)
 		
-		row = _fill_history_fields(row, prev_row)
+	cursor = execute_changelog_query('change event rows', _CHANGE_EVENT_ROWS_SQL,
+			params)
+	return CHANGELOG_COLUMNS, list(_pivot_change_events(cursor.fetchall()))
+
+def _pivot_change_events(events):
+	# Yields a changelog row for each note or email from its ordered events
+	row = None
+	source = None
+	for (issue_id, note_id, email_id, change_date, field, new_value, category,
+			note_type, raw_note, title, project, issue_type, disposition,
+			reported_by, tickets) in events:
 		
-		if _check_row(row):
-			issues.setdefault(row['issue_id'], {'label': '%s - %s' % (
-					row['issue_id'], row['current_title']),
-				'changes': []})
-			issues[row['issue_id']]['changes'].append(row)
+		if (issue_id, note_id, email_id) != source:
+			# Start the row for the next note or email
+			if row:
+				yield row
+			source = (issue_id, note_id, email_id)
+			if note_id:
+				row_type, row_id = 'note', note_id
+				raw_note = get_note_span_text(raw_note)
+			else:
+				row_type, row_id = 'email', email_id
+			row = [row_type, row_id, change_date, category, issue_id,
+					'', title, '', project, '', issue_type, '', disposition,
+					'', reported_by, '', tickets, note_type, change_date, raw_note]
+			
+		row[CHANGELOG_ROW_INDEX['changed_%s' % field]] = new_value
 		
-		prev_row = row
+	if row:
+		yield row
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def issue_changes_json(request, issue_id):
+	"""
+	Returns the changelog rows of one Issue as JSON, for opening an Issue on
+	the lazy Issue Changelog page. The emails have their whole bodies.
+	"""
+	from django.utils import simplejson
+	from django.core.serializers.json import DjangoJSONEncoder
+	
+	issue = get_object_or_404(Issue, pk=issue_id)
+	changes = dict(get_issue_changes([issue.pk])).get(issue.pk, {})
+	load_email_bodies(changes.get('changes', []))
+	return HttpResponse(simplejson.dumps({
+			'issue_id': issue.pk,
+			'label': changes.get('label', ''),
+			'changes': [dict(_.items()) for _ in changes.get('changes', [])],
+		}, cls=DjangoJSONEncoder), mimetype='application/json')
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def email_bodies_json(request):
+	"""
+	Returns the whole bodies of the emails in the "ids" GET data (a comma
+	separated list) as JSON, for expanding the email rows of the changelog
+	that only have a preview of the body.
+	"""
+	from django.utils import simplejson
+	
+	emailids = [_ for _ in request.GET.get('ids', '').split(',') if _.isdigit()]
+	bodies = get_email_bodies(emailids)
+	return HttpResponse(simplejson.dumps(dict([(str(k), v)
+			for k, v in bodies.items()])), mimetype='application/json')
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def issue_state_json(request, issue_id):
+	"""
+	Returns what the Issue's changelog fields were at the "at" date of the GET
+	data (now when it isn't given) as JSON.
+	"""
+	from django.utils import simplejson
+	
+	issue = get_object_or_404(Issue, pk=issue_id)
+	at = None
+	if request.GET.get('at'):
+		at = helpers.getDate(request.GET['at'])
 		
-	issues = sorted(issues.items())
+	state = get_issue_state(issue.pk, at)
+	state['issue_id'] = issue.pk
+	state['at'] = at and at.strftime('%m/%d/%Y %H:%M') or None
+	return HttpResponse(simplejson.dumps(state), mimetype='application/json')
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def changelog_block_cache_stats(request):
+	"""
+	Returns the hit rate of the rendered Issue block cache as JSON, for the
+	monitoring. Add reset=1 to start the counters over.
+	"""
+	from django.utils import simplejson
+	
+	stats = get_block_cache_stats()
+	if request.GET.get('reset') == '1':
+		reset_block_cache_stats()
+	return HttpResponse(simplejson.dumps(stats), mimetype='application/json')
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def changelog_query_profile(request, request_key):
+	'''
+	Shows the queries logged for one Issue Changelog request that was run with
+	profile_sql in the URL.
+	'''
+	logs = ChangelogQueryLog.objects.filter(request_key=request_key)
+	
+	output = []
+	for log in logs:
+		output.append('%s (%s)\n  %s params, %s rows, %.1f ms' % (log.name,
+				log.query_hash, log.param_count, log.row_count, log.wall_ms))
+		if log.explain:
+			output.append('\n'.join(['  %s' % _ for _ in log.explain.splitlines()]))
+		output.append('')
 		
-	return issues, total_issues
+	return HttpResponse('\n'.join(output), mimetype='text/plain')
 
 # ==============================================================================
 def export_issue_history_to_excel(request):
@@ -337,8 +917,8 @@ def export_issue_history_to_excel(request):
     #	))
 	
 	
-	# Get all issues for the given query
-	issues, total_issues = process_request(request, 1, -1)
+	# Get all issues for the given query. The total isn't used.
+	issues, total_issues = process_request(request, 1, -1, count='capped')
 	
 	row_count = 0
 	changed_font_style = 'font: name Arial, color black, height 160;'
@@ -528,4 +1108,184 @@ def export_issue_history_to_excel(request):
 	response = HttpResponse(mimetype='application/vnd.ms-excel')
 	response['Content-Disposition'] = 'attachment; filename=issue_changelog.xls'
 	book.save(response)
-	return response
\ No newline at end of file
+	return response
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def export_issue_history_to_csv(request):
+	"""
+	Streams the data given by the current Issue Changelog page query out as a
+	CSV file. The Issues are read a chunk at a time so the memory used stays
+	the same no matter how many Issues match, and there is no row limit like
+	the Excel export has.
+	"""
+	wheres, ewheres, wheres_args, ewheres_args = get_filter_wheres(request.GET)
+	
+	response = HttpResponse(_iter_issue_history_csv(wheres, ewheres,
+			wheres_args + ewheres_args), mimetype='text/csv')
+	response['Content-Disposition'] = 'attachment; filename=issue_changelog.csv'
+	return response
+
+def _iter_issue_history_csv(wheres, ewheres, params, chunk_size=200,
+		progress=None):
+	# Yields the CSV text for the changelog one chunk of Issues at a time.
+	# progress is called with the number of Issues written after each chunk.
+	return iter_history_csv(ISSUE_HISTORY, (wheres, ewheres), params,
+			chunk_size, progress)
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def change_history_json(request, entity_name):
+	"""
+	Returns a page of the change history of any registered entity ('issue',
+	'project' or 'project_task') as JSON. The GET data holds the entity's
+	filters, the 'page' and 'per_page', and 'after_id', the 'last_id' of the
+	previous page, to page by keyset instead of offset.
+	"""
+	from django.http import Http404
+	from django.utils import simplejson
+	from django.core.serializers.json import DjangoJSONEncoder
+	
+	try:
+		entity = get_entity(entity_name)
+	except KeyError:
+		raise Http404
+		
+	try:
+		page = int(request.GET.get('page', 1))
+		per_page = int(request.GET.get('per_page', 50))
+	except ValueError:
+		page, per_page = 1, 50
+	# A negative per_page would ask for every object, like the "all" page
+	page = max(page, 1)
+	per_page = max(min(per_page, 500), 1)
+	after_id = request.GET.get('after_id')
+	if after_id and not after_id.isdigit():
+		after_id = None
+		
+	wheres, params = entity.get_filter_wheres(request.GET)
+	histories, total, last_id = get_history_page(entity, wheres, params, page,
+			per_page, after_id, request.GET.get('count', 'exact'))
+	return HttpResponse(simplejson.dumps({
+			'entity': entity.name,
+			'total': total,
+			'last_id': last_id,
+			'histories': [{'id': i, 'history': h} for i, h in histories],
+		}, cls=DjangoJSONEncoder), mimetype='application/json')
+
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def export_change_history_to_csv(request, entity_name):
+	"""
+	Streams the change history of any registered entity that matches the GET
+	filters out as a CSV file, a chunk of objects at a time.
+	"""
+	from django.http import Http404
+	
+	try:
+		entity = get_entity(entity_name)
+	except KeyError:
+		raise Http404
+		
+	wheres, params = entity.get_filter_wheres(request.GET)
+	response = HttpResponse(iter_history_csv(entity, wheres, params),
+			mimetype='text/csv')
+	response['Content-Disposition'] = 'attachment; filename=%s_history.csv' % (
+			entity.name)
+	return response
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+@require_POST
+def queue_issue_history_export(request):
+	"""
+	Queues a CSV export of the Issue Changelog filter form's query, POSTed
+	by the page, for the export worker (see run_changelog_export_worker) and
+	returns the job's ID as JSON so the page can poll
+	issue_history_export_status.
+	"""
+	from django.utils import simplejson
+	
+	job = IssueChangelogExportJob(filters=request.POST.urlencode(),
+			created_by=request.user)
+	job.save()
+	return HttpResponse(simplejson.dumps({'job_id': job.pk}),
+			mimetype='application/json')
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def issue_history_export_status(request, job_id):
+	"""
+	Returns the status and the progress of a queued changelog export as JSON.
+	"""
+	from django.utils import simplejson
+	
+	job = get_object_or_404(IssueChangelogExportJob, pk=job_id)
+	return HttpResponse(simplejson.dumps({
+			'job_id': job.pk,
+			'status': job.status,
+			'total_issues': job.total_issues,
+			'done_issues': job.done_issues,
+			'error': job.error,
+		}), mimetype='application/json')
+
+# ==============================================================================
+@login_required
+@user_passes_test(permissions.isAdmin, login_url='/user/not_authorized/')
+def download_issue_history_export(request, job_id):
+	"""
+	Sends the finished file of a queued changelog export.
+	"""
+	from django.http import Http404
+	
+	job = get_object_or_404(IssueChangelogExportJob, pk=job_id)
+	if job.status != 'done' or not job.file_path:
+		raise Http404
+		
+	response = HttpResponse(open(job.file_path, 'rb'), mimetype='text/csv')
+	response['Content-Disposition'] = 'attachment; filename=issue_changelog.csv'
+	return response
+
+# ==============================================================================
+def build_issue_history_export(job):
+	"""
+	Writes the CSV file for an IssueChangelogExportJob, updating the job's
+	progress after every chunk of Issues. Returns the path of the file.
+	"""
+	import os
+	from django.http import QueryDict
+	
+	post = QueryDict(job.filters)
+	wheres, ewheres, wheres_args, ewheres_args = get_filter_wheres(post)
+	params = wheres_args + ewheres_args
+	
+	export_dir = getattr(settings, 'ISSUE_CHANGELOG_EXPORT_DIR',
+			os.path.join(settings.MEDIA_ROOT, 'changelog_exports'))
+	if not os.path.isdir(export_dir):
+		os.makedirs(export_dir)
+	file_path = os.path.join(export_dir, 'issue_changelog_%s.csv' % job.pk)
+	
+	total_issues = count_ids(_get_issue_ids_sql(wheres, ewheres), params,
+			column='issue')
+	update_export_job(job.pk, total_issues=total_issues)
+	
+	def _progress(done_issues):
+		update_export_job(job.pk, done_issues=done_issues)
+	
+	f = open(file_path, 'wb')
+	try:
+		try:
+			for chunk in _iter_issue_history_csv(wheres, ewheres, params,
+					progress=_progress):
+				f.write(chunk)
+		finally:
+			f.close()
+	except:
+		# Don't leave the partial file behind for a failed job
+		os.remove(file_path)
+		raise
+	return file_path
@@ -0,0 +1,17 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+	help = 'Adds the stored dedupe keys for the Issue Changelog and fills them in for the existing notes and emails.'
+	option_list = BaseCommand.option_list + (
+		make_option('--chunk-size', dest='chunk_size', type='int', default=10000,
+				help='Number of note or email IDs to update per transaction.'),
+	)
+
+	def handle(self, *args, **options):
+		from app.historical_note_models import backfill_changelog_dedupe_keys
+
+		for table, last_id, total_updated in backfill_changelog_dedupe_keys(
+				options['chunk_size']):
+			print 'Backfilled %s through #%s (%s rows)' % (table, last_id,
+					total_updated)
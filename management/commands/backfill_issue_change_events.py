@@ -0,0 +1,19 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+	help = 'Fills the issue_change_events table from the existing notes and emails.'
+	option_list = BaseCommand.option_list + (
+		make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+				help='Number of Issues to rebuild per transaction.'),
+		make_option('--start-issue', dest='start_issue', type='int', default=0,
+				help='Only backfill Issues with an ID greater than this one.'),
+	)
+
+	def handle(self, *args, **options):
+		from app.historical_note_models import backfill_issue_change_events
+
+		for last_issue, total_events in backfill_issue_change_events(
+				options['chunk_size'], options['start_issue']):
+			print 'Backfilled through Issue #%s (%s events)' % (last_issue,
+					total_events)
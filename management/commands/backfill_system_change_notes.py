@@ -0,0 +1,19 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+	help = 'Adds the notes.is_system_change flag and sets it on the existing system notes.'
+	option_list = BaseCommand.option_list + (
+		make_option('--chunk-size', dest='chunk_size', type='int', default=10000,
+				help='Number of note IDs to check per transaction.'),
+		make_option('--start-note', dest='start_note', type='int', default=0,
+				help='Only backfill notes with an ID greater than this one.'),
+	)
+
+	def handle(self, *args, **options):
+		from app.historical_note_models import backfill_system_change_notes
+
+		for last_note, total_flagged in backfill_system_change_notes(
+				options['chunk_size'], options['start_note']):
+			print 'Backfilled through Note #%s (%s system notes)' % (last_note,
+					total_flagged)
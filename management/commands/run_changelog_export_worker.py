@@ -0,0 +1,16 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+	help = 'Builds the queued Issue Changelog exports.'
+	option_list = BaseCommand.option_list + (
+		make_option('--poll-interval', dest='poll_interval', type='int', default=5,
+				help='Seconds to wait between checks of an empty queue.'),
+		make_option('--once', dest='run_once', action='store_true', default=False,
+				help='Exit once the queue is empty.'),
+	)
+
+	def handle(self, *args, **options):
+		from app.historical_note_jobs import run_changelog_export_worker
+
+		run_changelog_export_worker(options['poll_interval'], options['run_once'])
@@ -14,8 +14,13 @@ def _process_response(request, response):
 #		response['Expires'] = (datetime.now() + timedelta(days=3)).strftime('%A %d %b %Y 00:00:00 GMT')
 		response['Cache-Control'] = 'public, must-revalidate'
 
+	# Streamed responses are compressed as they are sent, so their content
+	# must not be read here
+	streaming = _is_streaming(response)
+
 	# It's not worth compressing non-OK or really short responses.
-	if response.status_code != 200 or len(response.content) < 200:
+	if response.status_code != 200 or (not streaming and
+			len(response.content) < 200):
 		return response
 			
 	patch_vary_headers(response, ('Accept-Encoding',))
@@ -34,11 +39,54 @@ def _process_response(request, response):
 	if 'gzip' not in ae:
 		return response
 			
+	if streaming:
+		if hasattr(response, 'streaming_content'):
+			response.streaming_content = _compress_sequence(
+					response.streaming_content)
+		else:
+			response._container = _compress_sequence(response._container,
+					getattr(response, '_charset', 'utf-8'))
+		# The length isn't known until the last chunk is sent
+		if response.has_header('Content-Length'):
+			del response['Content-Length']
+		response['Content-Encoding'] = 'gzip'
+		return response
+		
 	response.content = compress_string(response.content)
 	response['Content-Encoding'] = 'gzip'
 	response['Content-Length'] = str(len(response.content))
 	return response
 
+def _is_streaming(response):
+	# Responses made from an iterator, like the CSV exports, are streamed.
+	# StreamingHttpResponse is marked as streaming. Django 1.4 to 1.6 keep a
+	# flag on an HttpResponse made from an iterator, which Django 1.5 and 1.6
+	# still mark as not streaming, and older versions keep _is_string.
+	if getattr(response, 'streaming', False):
+		return True
+	if hasattr(response, '_base_content_is_iter'):
+		return response._base_content_is_iter
+	return not getattr(response, '_is_string', True)
+
+def _compress_sequence(sequence, charset='utf-8'):
+	'''
+	Yields the gzip of the chunks in the sequence as they come, so a streamed
+	response is never held in memory. Each chunk is flushed so the browser
+	gets the data as soon as it is made.
+	'''
+	import zlib
+	
+	# 16 + MAX_WBITS makes zlib write the gzip header and trailer
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for chunk in sequence:
+		if isinstance(chunk, unicode):
+			chunk = chunk.encode(charset)
+		data = compressor.compress(chunk)
+		data += compressor.flush(zlib.Z_SYNC_FLUSH)
+		if data:
+			yield data
+	yield compressor.flush()
+
 
 # ==============================================================================
 class ErrorLoggingMiddleware(object):
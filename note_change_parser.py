@@ -0,0 +1,181 @@
+'''
+Parses the "Changed X from ... to ..." system notes and the email subjects used
+by the Issue Changelog. These used to be substring() calls in the changelog
+SQL; doing them here keeps the work on the web workers instead of the shared
+database. The results match what the SQL returned.
+
+parse_change_lines() reads the same notes line by line for the Project and
+Project Task histories in historical_note_engine.
+'''
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Postgres lets "." match newlines, so DOTALL is used on all of these.
+# Quotes around the values can be &quot;, " or '.
+_QUOTE = '(?:&quot;|"|\')'
+
+# The patterns in CHANGELOG_FIELDS order. The reported_by pattern is the only
+# one that the SQL had a fallback for, which the caller handles.
+NOTE_CHANGE_PATTERNS = [
+	('title', re.compile(r'.*[Tt]itle.*?to %s(.+?)%s.*' % (_QUOTE, _QUOTE),
+			re.DOTALL)),
+	('project', re.compile(r'.*[Ii]ssue [Pp]roject.*?to %s(.+?)%s.*' % (
+			_QUOTE, _QUOTE), re.DOTALL)),
+	('issue_type', re.compile(r'.*[Ii]ssue [Tt]ype.*?to %s(.+?)%s.*' % (
+			_QUOTE, _QUOTE), re.DOTALL)),
+	# Postgres' substring() only returns the first group, so a match on the
+	# "Issue Disposition ... to" half gives nothing, same as the SQL did.
+	('issue_disposition', re.compile(r"(?:.*disposition of '(.+?)'.*)|"
+			r"(?:.*[Ii]ssue [Dd]isposition.*?to %s(.+?)%s.*)" % (_QUOTE, _QUOTE),
+			re.DOTALL)),
+	('reported_by', re.compile(r'.*[Rr]eported [Bb]y.*?to %s(.+?)%s.*' % (
+			_QUOTE, _QUOTE), re.DOTALL)),
+	('tickets', re.compile(r'.*[Tt]ickets.*?to %s(.+?)%s.*' % (_QUOTE, _QUOTE),
+			re.DOTALL)),
+]
+
+# The text of the system note's <span>. Non-greedy like the SQL version, where
+# the first quantifier made the whole pattern non-greedy.
+_SPAN_RE = re.compile(r'<span.*?>(.+?)</span>', re.DOTALL)
+
+# The title in an email subject: "[zt 1234] The title"
+_SUBJECT_TITLE_RE = re.compile(r'\[zt [0-9]+\] (.+)', re.DOTALL)
+
+# ==============================================================================
+class _LRUCache(object):
+	# A small thread safe least-recently-used cache
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.items = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		self.lock.acquire()
+		try:
+			value = self.items.pop(key)
+		except KeyError:
+			self.misses += 1
+			self.lock.release()
+			return None
+		self.items[key] = value
+		self.hits += 1
+		self.lock.release()
+		return value
+
+	def set(self, key, value):
+		self.lock.acquire()
+		try:
+			self.items.pop(key, None)
+			self.items[key] = value
+			while len(self.items) > self.max_size:
+				self.items.popitem(last=False)
+		finally:
+			self.lock.release()
+
+_note_cache = _LRUCache(20000)
+
+# ==============================================================================
+def _clean(value):
+	# Same as trim(replace(value, E'\n', ' ')) in the SQL
+	if value is None:
+		return None
+	return value.replace('\n', ' ').strip(' ')
+
+def _note_key(note):
+	if isinstance(note, unicode):
+		note = note.encode('utf-8')
+	return hashlib.md5(note).hexdigest()
+
+# ==============================================================================
+def parse_note(note):
+	'''
+	Returns the new values that a system note changed the Issue's fields to,
+	in CHANGELOG_FIELDS order (None for the fields it didn't match), followed
+	by the text of the note's <span> with &quot; turned into quotes.
+
+	The results are remembered by the note's hash since the same notes get
+	parsed over and over.
+	'''
+	if not note:
+		return [None] * len(NOTE_CHANGE_PATTERNS) + [None]
+
+	key = _note_key(note)
+	parsed = _note_cache.get(key)
+	if parsed is not None:
+		return parsed
+
+	parsed = []
+	for field, pattern in NOTE_CHANGE_PATTERNS:
+		m = pattern.match(note)
+		parsed.append(m and _clean(m.group(1)))
+
+	m = _SPAN_RE.search(note)
+	span = None
+	if m:
+		span = m.group(1).replace('\n', ' ').replace('&quot;', '"').strip(' ')
+	parsed.append(span)
+
+	_note_cache.set(key, parsed)
+	return parsed
+
+def get_note_span_text(note):
+	# Returns only the <span> text of the system note
+	return parse_note(note)[-1]
+
+def parse_email_subject_title(subject):
+	'''
+	Returns the Issue title from an email subject, or a single space when the
+	subject isn't in the "[zt 1234] Title" format.
+	'''
+	m = subject and _SUBJECT_TITLE_RE.search(subject)
+	if not m:
+		return ' '
+	return m.group(1).strip(' ')
+
+def get_parser_stats():
+	# For monitoring how well the memo works
+	return {'hits': _note_cache.hits, 'misses': _note_cache.misses,
+			'size': len(_note_cache.items)}
+
+# ==============================================================================
+# The lines that SystemNoteForm writes in its notes' <span>
+_CHANGE_LINE_RES = [
+	('changed', re.compile(r'^Changed (.+?)(?: from "(.*)")? to "(.*)"$', re.DOTALL)),
+	('added', re.compile(r'^Added (.+?)() "(.*)"$', re.DOTALL)),
+	('removed', re.compile(r'^Removed (.+?) "(.*)"()$', re.DOTALL)),
+]
+
+_change_lines_cache = _LRUCache(20000)
+
+def parse_change_lines(note):
+	'''
+	Returns an (action, field, old value, new value) tuple for each line of a
+	system note written by SystemNoteForm, where the action is 'changed',
+	'added' or 'removed'. Values that the line doesn't have are blank.
+	'''
+	if not note:
+		return []
+
+	key = _note_key(note)
+	lines = _change_lines_cache.get(key)
+	if lines is not None:
+		return lines
+
+	lines = []
+	m = _SPAN_RE.search(note)
+	if m:
+		for line in m.group(1).replace('&quot;', '"').split('\n'):
+			line = line.strip()
+			for action, pattern in _CHANGE_LINE_RES:
+				m = pattern.match(line)
+				if m:
+					field, old, new = m.groups()
+					lines.append((action, field, old or '', new or ''))
+					break
+
+	_change_lines_cache.set(key, lines)
+	return lines
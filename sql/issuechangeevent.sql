@@ -0,0 +1,9 @@
+-- The Issue Changelog reads every change of an Issue in date order
+CREATE INDEX issue_change_events_issue_date_idx ON issue_change_events (issue, change_date, issue_change_eventsid);
+
+-- The changelog filters match on the changed field and the ID of its new value
+CREATE INDEX issue_change_events_field_value_idx ON issue_change_events (field, new_value_id);
+
+-- Changed values that couldn't be matched to an ID are filtered on their text
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX issue_change_events_new_value_trgm_idx ON issue_change_events USING gin (new_value gin_trgm_ops);
@@ -0,0 +1,4 @@
+-- Backfill the first note date of every existing Issue
+INSERT INTO issue_first_notes (issue, first_note_at)
+SELECT issue, MIN(entry_date) FROM notes GROUP BY issue HAVING issue IS NOT NULL;
+
@@ -0,0 +1,2 @@
+-- get_issue_state() looks up the last snapshot of an Issue before a time
+CREATE INDEX issue_state_snapshots_issue_taken_idx ON issue_state_snapshots (issue, taken_at, last_event);
@@ -0,0 +1,7 @@
+-- The flag that the Issue Changelog finds the system notes by. It is set by
+-- the forms and by backfill_system_change_notes for the existing notes. See
+-- add_system_change_flag(), which does the same for an existing database.
+ALTER TABLE notes ADD COLUMN IF NOT EXISTS is_system_change boolean NOT NULL DEFAULT false;
+CREATE INDEX IF NOT EXISTS notes_system_change_issue_idx ON notes (issue, entry_date) WHERE is_system_change AND is_active;
+CREATE INDEX IF NOT EXISTS notes_system_change_project_idx ON notes (project, entry_date) WHERE is_system_change AND is_active;
+CREATE INDEX IF NOT EXISTS notes_system_change_project_task_idx ON notes (project_task, entry_date) WHERE is_system_change AND is_active;
@@ -0,0 +1,192 @@
+'''
+Tests for the Issue Changelog and the gzip middleware. The tests that need
+changelog data create the lookup values (types, dispositions, projects,
+people, note types and categories and an admin user) in the empty test
+database and generate the rest with historical_note_benchmarks.
+'''
+import unittest
+from django.conf import settings
+from django.test import TransactionTestCase
+from django.db import connection
+
+# ==============================================================================
+class ChangelogDataTestCase(TransactionTestCase):
+	'''
+	Fills the database with a small set of made up Issues for each test. It is
+	a TransactionTestCase because the data has to be committed for the other
+	connections that the changelog opens to see it.
+	'''
+	total_notes = 400
+	notes_per_issue = 10
+
+	# None of the values is part of another one's name, so the filters match
+	# the same Issues however they are searched
+	issue_types = ['Bug', 'Incident', 'Feature']
+	issue_dispositions = ['In Support', 'Resolved', 'Closed']
+	issue_projects = ['ledsSuite', 'Reports', 'Billing']
+	people = [('John', 'Smith'), ('Mary', 'Jones'), ('Ann', 'Lee')]
+
+	def setUp(self):
+		from django.contrib.auth.models import User
+		from app.models import IssueType, IssueDisposition, IssueProject, \
+				Person, NoteType, NoteCategory
+		from app import historical_note_benchmarks as b
+
+		# The lookup values that generate_changelog_data() picks from
+		for value in self.issue_types:
+			IssueType.objects.get_or_create(type=value)
+		for value in self.issue_dispositions:
+			IssueDisposition.objects.get_or_create(disposition=value)
+		for value in self.issue_projects:
+			IssueProject.objects.get_or_create(name=value)
+		for first_name, last_name in self.people:
+			Person.objects.get_or_create(first_name=first_name,
+					last_name=last_name)
+		NoteType.objects.get_or_create(type='Note')
+		NoteCategory.objects.get_or_create(category='Issue')
+		if not User.objects.filter(is_superuser=True).exists():
+			User.objects.create_superuser('changelog_test',
+					'changelog_test@example.com', 'changelog_test')
+
+		b.generate_changelog_data(self.total_notes, self.notes_per_issue)
+
+	def tearDown(self):
+		from app import historical_note_benchmarks as b
+		b.delete_changelog_data()
+
+# ==============================================================================
+class ChangelogFilterTest(ChangelogDataTestCase):
+	def test_events_match_the_text_search(self):
+		# The filters find the same Issues with the issue_change_events table
+		# as with the old ILIKE search, apart from values that are part of
+		# another value's name
+		from app import historical_note_benchmarks as b
+
+		filters = dict(b.COMPARED_FILTERS)
+		for name, value, only_events, only_text in b.compare_changelog_filters(
+				verbose=False):
+			self.assertEqual(only_events, [], '%s %s' % (name, value))
+
+			dummy, names = b._get_lookup_values(filters[name])
+			if not [_ for _ in names if _ != value and value.lower() in _.lower()]:
+				self.assertEqual(only_text, [], '%s %s' % (name, value))
+
+# ==============================================================================
+def _flatten_changes(issues):
+	# The changelog dictionary with its ChangelogRows turned into their values
+	# so two changelogs can be compared
+	return [(issue_id, issue['label'], [list(_.values) for _ in issue['changes']])
+			for issue_id, issue in sorted(issues.items())]
+
+class ParallelAssemblyTest(ChangelogDataTestCase):
+	def test_pool_matches_serial(self):
+		# The process pool builds exactly what the serial path does, and the
+		# connection of this process still works afterwards
+		from app import historical_note_views as views
+		from app.historical_note_benchmarks import BENCH_TITLE_PREFIX
+
+		cursor = connection.cursor()
+		cursor.execute('SELECT issuesid FROM issues WHERE title LIKE %s '
+				'ORDER BY issuesid', [BENCH_TITLE_PREFIX + '%'])
+		issueids = [_[0] for _ in cursor.fetchall()]
+		self.assertTrue(len(issueids) > 7)
+
+		serial = views._build_issue_changes(issueids)
+		pooled = views._build_issue_changes_in_chunks(issueids, workers=3,
+				chunk_size=7)
+		self.assertEqual(_flatten_changes(serial), _flatten_changes(pooled))
+
+		cursor = connection.cursor()
+		cursor.execute('SELECT COUNT(*) FROM issues WHERE issuesid = ANY(%s)',
+				[issueids])
+		self.assertEqual(cursor.fetchone()[0], len(issueids))
+
+	def test_streamed_pool_matches_streamed(self):
+		# The "all" page's pooled stream yields the same Issues in the same
+		# order as the server-side cursor's stream
+		from app import historical_note_views as views
+		from app.historical_note_benchmarks import BENCH_TITLE_PREFIX
+
+		cursor = connection.cursor()
+		cursor.execute('SELECT issuesid FROM issues WHERE title LIKE %s '
+				'ORDER BY issuesid', [BENCH_TITLE_PREFIX + '%'])
+		issueids = [_[0] for _ in cursor.fetchall()]
+
+		streamed = list(views.iter_issue_changes(issueids))
+		pooled = list(views._iter_pooled_issue_changes(issueids, 3, 7))
+		self.assertEqual([_[0] for _ in streamed], [_[0] for _ in pooled])
+		self.assertEqual(_flatten_changes(dict(streamed)),
+				_flatten_changes(dict(pooled)))
+
+# ==============================================================================
+class ChangeCountTest(ChangelogDataTestCase):
+	def test_counts_match_the_changelog(self):
+		# The lazy page's change counts are the number of rows each Issue's
+		# changelog has when it is opened
+		from app import historical_note_views as views
+		from app.historical_note_benchmarks import BENCH_TITLE_PREFIX
+
+		cursor = connection.cursor()
+		cursor.execute('SELECT issuesid FROM issues WHERE title LIKE %s '
+				'ORDER BY issuesid', [BENCH_TITLE_PREFIX + '%'])
+		issueids = [_[0] for _ in cursor.fetchall()]
+
+		issues = views._build_issue_changes(issueids)
+
+		# The counts are only read from the events when they are turned on
+		old_use_events = getattr(settings, 'ISSUE_CHANGELOG_USE_EVENTS', False)
+		settings.ISSUE_CHANGELOG_USE_EVENTS = True
+		try:
+			counts = dict([(issue_id, issue['change_count']) for issue_id, issue
+					in views.get_issue_change_counts(issueids)])
+		finally:
+			settings.ISSUE_CHANGELOG_USE_EVENTS = old_use_events
+		self.assertEqual(counts, dict([(issue_id, len(issue['changes']))
+				for issue_id, issue in issues.items()]))
+
+# ==============================================================================
+class GzipMiddlewareTest(unittest.TestCase):
+	def _gunzip(self, data):
+		import gzip
+		from cStringIO import StringIO
+		return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+	def _request(self):
+		from django.test.client import RequestFactory
+		return RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+	def test_compress_sequence(self):
+		from app.middleware import _compress_sequence
+
+		chunks = [u'Issue ID,Title\n'] + ['%s,caf\xc3\xa9\n' % i for i in range(2000)]
+		data = ''.join(_compress_sequence(iter(chunks)))
+		self.assertEqual(self._gunzip(data), ''.join([_.encode('utf-8')
+				if isinstance(_, unicode) else _ for _ in chunks]))
+
+	def test_streamed_response(self):
+		# An iterator response is compressed as it is read, without a length
+		from django.http import HttpResponse
+		from app.middleware import _process_response, _is_streaming
+
+		chunks = ['%s,The report will not print\n' % i for i in range(2000)]
+		response = HttpResponse(iter(chunks), mimetype='text/csv')
+		self.assertTrue(_is_streaming(response))
+
+		response = _process_response(self._request(), response)
+		self.assertEqual(response['Content-Encoding'], 'gzip')
+		self.assertFalse(response.has_header('Content-Length'))
+		self.assertEqual(self._gunzip(''.join(response)), ''.join(chunks))
+
+	def test_buffered_response(self):
+		# A string response keeps the one-shot compression and its length
+		from django.http import HttpResponse
+		from app.middleware import _process_response, _is_streaming
+
+		content = 'The report will not print for this user. ' * 50
+		response = HttpResponse(content, mimetype='text/html')
+		self.assertFalse(_is_streaming(response))
+
+		response = _process_response(self._request(), response)
+		self.assertEqual(response['Content-Encoding'], 'gzip')
+		self.assertEqual(response['Content-Length'], str(len(response.content)))
+		self.assertEqual(self._gunzip(response.content), content)